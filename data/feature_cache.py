@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    Compute the SHA-1 of a file's content
+    Args:
+        path (str): file path
+        block_size (int): bytes read at a time
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_fingerprint(path):
+    """
+    Cheap change detector for a file
+    Args:
+        path (str): file path
+    Returns:
+        (int, int): modification time in nanoseconds and size in bytes
+    """
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def write_json(path, obj):
+    """
+    Atomically replace a JSON file, so a crash never leaves a half-written index behind
+    Args:
+        path (str): destination path
+        obj: JSON-serializable object
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(temp_path, path)
+
+
+def entry_file(root, version, content_hash):
+    return f"{root}/{content_hash}.v{version}.npy"
+
+
+def lookup(path, record, root, version):
+    """
+    Find the cache entry of a source file from its index record alone, so it can run in a worker process
+    Args:
+        path (str): source file path
+        record (dict): index record of the file, None if it was never seen
+        root (str): cache directory
+        version (int): extractor version of the cache
+    Returns:
+        (str, dict): path of the entry file (None on a cache miss) and the up to date index record of the file
+    """
+    mtime, size = file_fingerprint(path)
+    if record is not None and record["mtime"] == mtime and record["size"] == size:
+        entry_path = entry_file(root, version, record["hash"])
+        if os.path.exists(entry_path):
+            return entry_path, record
+
+    # The file was touched, moved or never seen: fall back to its content
+    record = {"mtime": mtime, "size": size, "hash": file_hash(path)}
+    entry_path = entry_file(root, version, record["hash"])
+    if not os.path.exists(entry_path):
+        return None, record
+    return entry_path, record
+
+
+class FeatureCache:
+    def __init__(self, root, version):
+        """
+        Per-file cache of extracted features, one .npy entry per source file
+        Entries are content-addressed (named after the source file's SHA-1 and the extractor version), and an index
+        maps each source path to its last seen mtime, size and hash, so unchanged files are recognized with one stat.
+        Args:
+            root (str): cache directory, created if missing
+            version (int): extractor version, bump it whenever the extracted features change
+        """
+        self.root = root
+        self.version = version
+        self.index_path = f"{root}/index.json"
+        os.makedirs(root, exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        self.dirty = False
+
+    def entry_path(self, content_hash):
+        return entry_file(self.root, self.version, content_hash)
+
+    def resolve(self, path):
+        """
+        Find the cache entry of a source file without loading it
+        Args:
+            path (str): source file path
+        Returns:
+            (str, str): path of the entry file (None on a cache miss) and the content hash of the source file,
+                to be passed on to store so a miss is not hashed twice
+        """
+        entry_path, record = lookup(path, self.index.get(path), self.root, self.version)
+        if entry_path is not None:
+            self.update(path, record)
+        return entry_path, record["hash"]
+
+    def update(self, path, record):
+        """
+        Record the fingerprint and hash of a source file found by lookup
+        Args:
+            path (str): source file path
+            record (dict): index record returned by lookup
+        """
+        if self.index.get(path) != record:
+            self.index[path] = record
+            self.dirty = True
+
+    def load(self, path, mmap_mode=None):
+        """
+        Load the cached features of a source file
+        Args:
+            path (str): source file path
+            mmap_mode (str): passed to np.load
+        Returns:
+            np.ndarray: cached features, None on a cache miss
+        """
+        entry_path, _ = self.resolve(path)
+        if entry_path is None:
+            return None
+        return np.load(entry_path, mmap_mode=mmap_mode)
+
+    def store(self, path, features, content_hash=None):
+        """
+        Save the features extracted from a source file
+        Args:
+            path (str): source file path
+            features (np.ndarray): extracted features
+            content_hash (str): hash returned by resolve, the file is hashed again when omitted
+        Returns:
+            str: path of the entry file
+        """
+        mtime, size = file_fingerprint(path)
+        if content_hash is None:
+            content_hash = file_hash(path)
+        entry_path = self.entry_path(content_hash)
+        temp_path = f"{entry_path}.tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, features)
+        os.replace(temp_path, entry_path)
+        self.index[path] = {"mtime": mtime, "size": size, "hash": content_hash}
+        self.dirty = True
+        return entry_path
+
+    def save(self):
+        """ Persist the index """
+        if self.dirty:
+            write_json(self.index_path, self.index)
+            self.dirty = False
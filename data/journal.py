@@ -0,0 +1,64 @@
+import json
+import os
+
+
+class Journal:
+    def __init__(self, path):
+        """
+        Append-only log of committed preprocessing batches, one JSON record per line
+        A record is only considered committed once its line is fully on disk, a torn last line left by a crash
+        is ignored.
+        Args:
+            path (str): journal file, created on the first commit
+        """
+        self.path = path
+        self.records = []
+        if not os.path.exists(path):
+            return
+        torn = False
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    if not line.endswith("\n"):
+                        raise ValueError("torn line")
+                    self.records.append(json.loads(line))
+                except ValueError:
+                    torn = True
+                    break
+        if torn:
+            # Drop the torn line before anything gets appended after it
+            with open(f"{path}.tmp", "w") as f:
+                f.writelines(json.dumps(record) + "\n" for record in self.records)
+            os.replace(f"{path}.tmp", path)
+
+    def completed_files(self):
+        """
+        Returns:
+            set(str): every file of every committed batch
+        """
+        return {path for record in self.records for path in record["files"]}
+
+    def shards(self):
+        """
+        Returns:
+            List(dict): {"file", "rows"} records of the committed shards, in commit order
+        """
+        return [record["shard"] for record in self.records if record.get("shard") is not None]
+
+    def commit(self, record):
+        """
+        Durably append a record
+        Args:
+            record (dict): JSON-serializable record with a "files" list and an optional "shard"
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.records.append(record)
+
+    def clear(self):
+        self.records = []
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,9 +1,18 @@
-import glob
+import os
+from functools import partial
 
 import numpy as np
 import pretty_midi as pm
 from mido.midifiles.meta import KeySignatureError
 
+from data import midi_fast
+from data.feature_cache import FeatureCache, lookup
+from data.journal import Journal
+from data.manifest import FileManifest
+from data.parallel import imap_ordered
+from data.quarantine import Quarantine
+from data.ragged import RaggedArray
+from data.shards import ShardWriter, ShardedArray
 from streaming.midi_objects import MidiSong
 
 CHUNK_SIZE = 64
@@ -42,6 +51,13 @@ DATASET_INFO = {
 
 CACHE_PATH = "C:/One/CMU/DeepLearning/note-zart/data/caches"
 TEMP_PATH = "C:/One/CMU/DeepLearning/note-zart/data/temp"
+MANIFEST_PATH = f"{CACHE_PATH}/manifests"
+
+QUARANTINE_PATH = f"{CACHE_PATH}/quarantine.json"
+
+# Dataset name => FileManifest, shared by every caller in this process
+_manifests = {}
+_quarantine = None
 
 
 def test_play(song):
@@ -64,16 +80,72 @@ def test_play(song):
         clock.tick(30)
 
 
-def get_all_files(dataset_name="ADL"):
+def get_manifest(dataset_name="ADL", refresh=True):
+    """
+    Fetches the persistent file manifest of a particular dataset
+    Args:
+        dataset_name (str): dataset name, use keys of DATASET_INFO
+        refresh (bool): rescan the directories that changed since the last refresh, a manifest that was
+            never built is always scanned
+    Returns:
+        FileManifest: manifest of the MIDI files
+    """
+    manifest = _manifests.get(dataset_name)
+    if manifest is None:
+        dataset_info = DATASET_INFO[dataset_name]
+        manifest = FileManifest(f"{BASE_DATA_PATH}/{dataset_info['path']}", dataset_info["glob_params"],
+                                f"{MANIFEST_PATH}/{dataset_name}.json")
+        _manifests[dataset_name] = manifest
+    if refresh or not manifest.built:
+        manifest.refresh()
+    return manifest
+
+
+def get_quarantine():
+    """
+    Fetches the quarantine of MIDI files that failed to parse, shared by every caller in this process
+    Returns:
+        Quarantine: quarantined files
+    """
+    global _quarantine
+    if _quarantine is None:
+        _quarantine = Quarantine(QUARANTINE_PATH)
+    return _quarantine
+
+
+def get_all_files(dataset_name="ADL", refresh=True, skip_quarantined=True):
     """
     Fetches all files from a particular dataset
     Args:
         dataset_name (str): dataset name, use keys of DATASET_INFO
+        refresh (bool): rescan the directories that changed since the last call
+        skip_quarantined (bool): leave out files that failed to parse and did not change since
     Returns:
         List(str): paths to the MIDI files
     """
-    dataset_info = DATASET_INFO[dataset_name]
-    return glob.glob(f"{BASE_DATA_PATH}/{dataset_info['path']}/{dataset_info['glob_params']}")
+    paths = get_manifest(dataset_name, refresh=refresh).paths
+    if skip_quarantined:
+        paths = get_quarantine().filter(paths)
+    return paths
+
+
+def random_file(dataset_name="ADL", max_tries=100):
+    """
+    Picks a random, not quarantined file from a particular dataset without rescanning it
+    Args:
+        dataset_name (str): dataset name, use keys of DATASET_INFO
+        max_tries (int): number of picks before giving up on skipping quarantined files
+    Returns:
+        str: path to the MIDI file
+    """
+    manifest = get_manifest(dataset_name, refresh=False)
+    quarantine = get_quarantine()
+    path = manifest.sample(1)[0]
+    for _ in range(max_tries - 1):
+        if not quarantine.is_quarantined(path):
+            break
+        path = manifest.sample(1)[0]
+    return path
 
 
 def parse_midi(path):
@@ -86,70 +158,314 @@ def parse_midi(path):
     return midi
 
 
-def load_pitch_data(use_cache=False):
+def extract_pitch_data(midi):
+    """
+    Extract the pitch of every note in a MIDI file
+    Args:
+        midi (pm.PrettyMIDI): parsed MIDI file
+    Returns:
+        np.ndarray: int16 array of shape (notes,)
+    """
+    # Combine all instruments into one big note gallery for now
+    notes = []
+    for instrument in midi.instruments:
+        notes += instrument.notes
+    return np.array([note.pitch for note in notes], dtype=np.int16)
+
+
+def extract_note_data(midi):
+    """
+    Extract a (pitch, delay, duration) row for every note in a MIDI file
+    Args:
+        midi (pm.PrettyMIDI): parsed MIDI file
+    Returns:
+        np.ndarray: float64 array of shape (notes, 3)
+    """
+    # Combine all instruments into one big note gallery for now
+    notes = []
+    for instrument in midi.instruments:
+        prev_start = 0
+        for note in instrument.notes:
+            # Array: pitch, delay, duration
+            notes.append([note.pitch, note.start - prev_start, note.end - note.start])
+            prev_start = note.start
+    return np.array(notes, dtype=np.float64).reshape((-1, 3))
+
+
+# Kind => (PrettyMIDI extractor, fast extractor, PrettyMIDI extractor version, fast extractor version)
+# Bump a version whenever its extractor output changes, stale cache entries are then ignored
+FEATURE_EXTRACTORS = {
+    "pitch": (extract_pitch_data, midi_fast.pitch_data, 1, 1),
+    "note": (extract_note_data, midi_fast.note_data, 1, 1)
+}
+
+# Read notes with data.midi_fast instead of building full PrettyMIDI objects
+USE_FAST_EXTRACTOR = True
+
+
+def pitch_chunks(pitches, chunk_size=CHUNK_SIZE):
+    """
+    Split the pitches of one song into full chunks, dropping the incomplete tail
+    Args:
+        pitches (np.ndarray): array of shape (notes,)
+        chunk_size (int): how big each chunk is
+    Returns:
+        np.ndarray: array of shape (chunks, chunk_size, 1)
+    """
+    chunk_count = len(pitches) // chunk_size
+    return np.asarray(pitches[:chunk_count * chunk_size], dtype=int).reshape((chunk_count, chunk_size, 1))
+
+
+def note_sequence(notes, max_sequence_length=64):
+    """
+    Keep the first max_sequence_length notes of one song
+    Args:
+        notes (np.ndarray): array of shape (notes, 3)
+        max_sequence_length (int): number of notes to keep
+    Returns:
+        np.ndarray: array of shape (max_sequence_length, 3), None if the song is too short
+    """
+    if len(notes) < max_sequence_length:
+        return None
+    return np.array(notes[:max_sequence_length])
+
+
+def feature_cache(kind, fast):
+    """
+    Each extractor has its own cache, so switching USE_FAST_EXTRACTOR never reuses the other one's features
+    Args:
+        kind (str): feature kind, use keys of FEATURE_EXTRACTORS
+        fast (bool): cache of the fast extractor (including the files it hands over to PrettyMIDI)
+    Returns:
+        FeatureCache: per-file feature cache
+    """
+    _, _, version, fast_version = FEATURE_EXTRACTORS[kind]
+    if fast:
+        return FeatureCache(f"{CACHE_PATH}/features/{kind}/fast", fast_version)
+    return FeatureCache(f"{CACHE_PATH}/features/{kind}/pretty_midi", version)
+
+
+def _load_features(path, kind, fast=None):
+    """
+    Args:
+        fast (bool): try the fast extractor first, None reads USE_FAST_EXTRACTOR
+    Returns:
+        (np.ndarray, str): features and None, or None and the reason parsing failed
+    """
+    if fast is None:
+        fast = USE_FAST_EXTRACTOR
+    extractor, fast_extractor, _, _ = FEATURE_EXTRACTORS[kind]
+    try:
+        if fast:
+            try:
+                return fast_extractor(midi_fast.read_notes(path)), None
+            except midi_fast.UnsupportedMidiError:
+                pass
+        return extractor(pm.PrettyMIDI(path)), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def _load_cached_features(item, kind, fast, cache_root=None, cache_version=None):
+    """
+    Look a file up in the feature cache and only parse it on a miss, so hashing runs in the workers too
+    Args:
+        item ((str, dict)): file path and its feature cache index record, None if never seen
+        cache_root (str): feature cache directory, None skips the cache
+        cache_version (int): extractor version of the feature cache
+    Returns:
+        (str, dict, np.ndarray, str): entry path on a cache hit and the up to date index record of the file,
+            then on a miss the features and the reason parsing failed as returned by _load_features
+    """
+    path, record = item
+    if cache_root is not None:
+        entry_path, record = lookup(path, record, cache_root, cache_version)
+        if entry_path is not None:
+            return entry_path, record, None, None
+    features, reason = _load_features(path, kind, fast)
+    return None, record, features, reason
+
+
+def iter_features(paths, kind, num_workers=1, use_feature_cache=True):
+    """
+    Extract raw per-file features, reusing the per-file feature cache for files that did not change
+    Files that fail to parse are quarantined, and quarantined files are skipped until they change.
+    Args:
+        paths (List(str)): MIDI file paths
+        kind (str): feature kind, use keys of FEATURE_EXTRACTORS
+        num_workers (int): number of parsing processes, 1 parses serially, None uses all cores
+        use_feature_cache (bool): read and update the per-file feature cache
+    Yields:
+        (str, np.ndarray): path and its features in the same order as paths, features are None if unparseable
+    """
+    quarantine = get_quarantine()
+    paths = quarantine.filter(paths)
+    # read the toggle here, worker processes may not see a value changed after import
+    fast = USE_FAST_EXTRACTOR
+    load_file = partial(_load_cached_features, kind=kind, fast=fast)
+    cache = None
+    records = [None] * len(paths)
+    if use_feature_cache:
+        cache = feature_cache(kind, fast)
+        load_file = partial(load_file, cache_root=cache.root, cache_version=cache.version)
+        records = [cache.index.get(path) for path in paths]
+
+    # files are only hashed by the workers as they reach them, so the first features come out right away
+    hits = misses = 0
+    parsed = imap_ordered(load_file, list(zip(paths, records)), num_workers=num_workers)
+    try:
+        for (entry, record, features, reason), path in zip(parsed, paths):
+            if entry is not None:
+                hits += 1
+                cache.update(path, record)
+                yield path, np.load(entry)
+                continue
+            misses += 1
+            if features is None:
+                quarantine.add(path, reason)
+            elif cache is not None:
+                cache.store(path, features, content_hash=record["hash"])
+            yield path, features
+    finally:
+        print(f"Feature cache: {hits} hits, {misses} misses, {len(quarantine)} quarantined")
+        quarantine.save()
+        if cache is not None:
+            cache.save()
+
+
+def shard_root(kind, dataset_name, window):
+    """
+    Returns:
+        str: directory of the sharded dataset built by preprocess_corpus
+    """
+    return f"{CACHE_PATH}/shards/{kind}_{dataset_name}_{window}"
+
+
+def preprocess_corpus(kind="pitch", dataset_name="ADL", window=CHUNK_SIZE, batch_files=512, num_workers=1,
+                      use_feature_cache=True, restart=False):
+    """
+    Resumable corpus preprocessing into memory-mapped shards
+    Every batch_files source files, the windows extracted from them are written as one shard and the batch is
+    committed to a journal. A crashed or interrupted job picks up after its last committed batch, and new files
+    that appeared in the dataset since are added on the next run. While a job is running, ShardedArray(root)
+    already serves every committed shard for training.
+    Args:
+        kind (str): "pitch" for CHUNK_SIZE-note pitch chunks, "note" for the first notes of every song
+        dataset_name (str): dataset name, use keys of DATASET_INFO
+        window (int): chunk size for "pitch", max_sequence_length for "note"
+        batch_files (int): number of source files per committed batch
+        num_workers (int): number of parsing processes, 1 parses serially, None uses all cores
+        use_feature_cache (bool): only parse files missing from the per-file feature cache
+        restart (bool): discard the journal and every shard and start from scratch
+    Returns:
+        ShardedArray: view over the finished dataset
+    """
+    root = shard_root(kind, dataset_name, window)
+    journal = Journal(f"{root}/journal.jsonl")
+    if restart:
+        journal.clear()
+    if kind == "pitch":
+        writer = ShardWriter(root, np.int16, (window, 1), shards=journal.shards())
+    else:
+        writer = ShardWriter(root, np.float64, (window, 3), shards=journal.shards())
+
+    completed = journal.completed_files()
+    paths = [path for path in get_all_files(dataset_name=dataset_name) if path not in completed]
+    if completed:
+        print(f"Resuming {kind} preprocessing of {dataset_name}: {len(completed)} files done, {len(paths)} to go")
+
+    def commit(files, rows):
+        shard = writer.save_shard(np.concatenate(rows)) if rows else None
+        journal.commit({"shard": shard, "files": files})
+        if shard is not None:
+            writer.add_shard(shard)
+
+    batch_paths, batch_rows = [], []
+    for path, features in iter_features(paths, kind, num_workers=num_workers, use_feature_cache=use_feature_cache):
+        batch_paths.append(path)
+        if features is not None:
+            rows = pitch_chunks(features, window) if kind == "pitch" else note_sequence(features, window)
+            if rows is not None and len(rows):
+                batch_rows.append(rows if kind == "pitch" else rows[None])
+        if len(batch_paths) >= batch_files:
+            commit(batch_paths, batch_rows)
+            batch_paths, batch_rows = [], []
+    if batch_paths:
+        commit(batch_paths, batch_rows)
+    return ShardedArray(root)
+
+
+def load_pitch_data(use_cache=False, num_workers=1, use_feature_cache=True, lazy=False):
+    """
+    Load pitch-only training chunks of size=CHUNK_SIZE from the ADL dataset
+    Args:
+        use_cache (bool): load the previously saved chunks instead of building them, with lazy a partially
+            built dataset is resumed, or the chunks saved without lazy are memory-mapped if no shards exist yet
+        num_workers (int): number of parsing processes, 1 parses serially, None uses all cores
+        use_feature_cache (bool): only parse files missing from the per-file feature cache
+        lazy (bool): store the chunks as memory-mapped shards and return a ShardedArray view over them
+    Returns:
+        np.ndarray: array of shape (chunks, CHUNK_SIZE, 1), or a ShardedArray (or memory-mapped array) with that
+            shape if lazy
+    """
+    cache_path = f"{CACHE_PATH}/pitch_only_chunk_{CHUNK_SIZE}.npy"
+    if lazy:
+        # The journal does not know which files a non-lazy cache was built from, so it is served as is
+        # rather than converted into shards that a resumed job would then duplicate
+        if use_cache and not ShardedArray.exists(shard_root("pitch", "ADL", CHUNK_SIZE)) \
+                and os.path.exists(cache_path):
+            return np.load(cache_path, mmap_mode="r")
+        return preprocess_corpus("pitch", "ADL", CHUNK_SIZE, num_workers=num_workers,
+                                 use_feature_cache=use_feature_cache, restart=not use_cache)
     if use_cache:
-        with open(f"{CACHE_PATH}/pitch_only_chunk_{CHUNK_SIZE}.npy", "rb") as f:
+        with open(cache_path, "rb") as f:
             data = np.load(f)
         return data
 
-    def get_pitch_data(midi):
-        # Combine all instruments into one big note gallery for now
-        notes = []
-        for instrument in midi.instruments:
-            notes += instrument.notes
-        # NOTE: THIS IS CREATING AN ONE-ELEMENT ARRAY, MIGHT BREAK THINGS
-        return [[note.pitch] for note in notes]
-
     paths = get_all_files(dataset_name="ADL")
     data = []
-    for path in paths:
-        midi = parse_midi(path)
-        if not midi:
+    for _, pitches in iter_features(paths, "pitch", num_workers=num_workers, use_feature_cache=use_feature_cache):
+        if pitches is None:
             continue
-        pitches = get_pitch_data(midi)
 
         # Split MIDIs into chunks of size=CHUNK_SIZE
-        for chunk in split_chunks(pitches, CHUNK_SIZE):
-            if len(chunk) != CHUNK_SIZE:
-                continue
-            data.append(chunk)
+        data.append(pitch_chunks(pitches, CHUNK_SIZE))
 
-    data = np.array(data)
-    with open(f"{CACHE_PATH}/pitch_only_chunk_{CHUNK_SIZE}.npy", "wb") as f:
+    data = np.concatenate(data) if data else np.empty((0, CHUNK_SIZE, 1), dtype=int)
+    with open(cache_path, "wb") as f:
         np.save(f, data)
     return data
 
 
-def load_note_data(dataset_name="ADL", max_sequence_length=64, use_cache=False):
+def load_note_data(dataset_name="ADL", max_sequence_length=64, use_cache=False, num_workers=1,
+                   use_feature_cache=True, lazy=False):
+    """
+    Load (pitch, delay, duration) sequences of the first max_sequence_length notes of every song
+    Args:
+        dataset_name (str): dataset name, use keys of DATASET_INFO
+        max_sequence_length (int): number of notes per song, shorter songs are skipped
+        use_cache (bool): load the previously saved sequences instead of building them, with lazy a partially
+            built dataset is resumed
+        num_workers (int): number of parsing processes, 1 parses serially, None uses all cores
+        use_feature_cache (bool): only parse files missing from the per-file feature cache
+        lazy (bool): store the sequences as memory-mapped shards and return a ShardedArray view over them
+    Returns:
+        np.ndarray: array of shape (songs, max_sequence_length, 3), or a ShardedArray with that shape if lazy
+    """
+    if lazy:
+        return preprocess_corpus("note", dataset_name, max_sequence_length, num_workers=num_workers,
+                                 use_feature_cache=use_feature_cache, restart=not use_cache)
     if use_cache:
         with open(f"{CACHE_PATH}/full.npy", "rb") as f:
             data = np.load(f)
         return data
 
-    def get_note_data(midi):
-        # Combine all instruments into one big note gallery for now
-        notes = []
-        note_count = 0
-        for instrument in midi.instruments:
-            prev_start = 0
-            for note in instrument.notes:
-                if note_count >= max_sequence_length:
-                    break
-                # Array: pitch, delay, duration
-                notes.append([note.pitch, note.start - prev_start, note.end - note.start])
-                prev_start = note.start
-                note_count += 1
-        if len(notes) < max_sequence_length:
-            return None
-        return np.array(notes)
-
     paths = get_all_files(dataset_name=dataset_name)
     data = []
-    for path in paths:
-        midi = parse_midi(path)
-        if not midi:
+    for _, notes in iter_features(paths, "note", num_workers=num_workers, use_feature_cache=use_feature_cache):
+        if notes is None:
             continue
-        notes = get_note_data(midi)
+        notes = note_sequence(notes, max_sequence_length)
         if notes is not None:
             data.append(notes)
 
@@ -159,6 +475,107 @@ def load_note_data(dataset_name="ADL", max_sequence_length=64, use_cache=False):
     return data
 
 
+def load_ragged_data(kind="pitch", dataset_name="ADL", use_cache=False, num_workers=1, use_feature_cache=True):
+    """
+    Load every song of a dataset in full, as one flat note array plus per-song offsets
+    Unlike load_pitch_data and load_note_data nothing is dropped or padded, windows of any length can be cut
+    from the result with RaggedArray.window_starts.
+    Args:
+        kind (str): "pitch" for int16 pitches of shape (notes,), "note" for float64 (pitch, delay, duration) rows,
+            the same dtype as load_note_data
+        dataset_name (str): dataset name, use keys of DATASET_INFO
+        use_cache (bool): memory-map the previously saved songs instead of building them
+        num_workers (int): number of parsing processes, 1 parses serially, None uses all cores
+        use_feature_cache (bool): only parse files missing from the per-file feature cache
+    Returns:
+        RaggedArray: one entry per parseable song
+    """
+    root = f"{CACHE_PATH}/ragged/{kind}_{dataset_name}"
+    dtype = np.int16 if kind == "pitch" else np.float64
+    if use_cache and RaggedArray.exists(root):
+        data = RaggedArray.load(root)
+        # songs saved with another dtype are rebuilt
+        if data.values.dtype == dtype:
+            return data
+
+    paths = get_all_files(dataset_name=dataset_name)
+    songs = []
+    for _, features in iter_features(paths, kind, num_workers=num_workers, use_feature_cache=use_feature_cache):
+        if features is not None:
+            songs.append(features)
+
+    data = RaggedArray.from_arrays(songs, dtype=dtype, note_shape=() if kind == "pitch" else (3,))
+    data.save(root)
+    return RaggedArray.load(root)
+
+
+def pitch_windows(dataset_name="ADL", chunk_size=CHUNK_SIZE, num_workers=1, use_feature_cache=True):
+    """
+    Stream pitch-only chunks as each file is parsed, without building the whole dataset in memory
+    Args:
+        dataset_name (str): dataset name, use keys of DATASET_INFO
+        chunk_size (int): number of notes per chunk, incomplete tails are dropped
+        num_workers (int): number of parsing processes, 1 parses serially, None uses all cores
+        use_feature_cache (bool): only parse files missing from the per-file feature cache
+    Yields:
+        np.ndarray: int64 array of shape (chunk_size, 1)
+    """
+    paths = get_all_files(dataset_name=dataset_name)
+    for _, pitches in iter_features(paths, "pitch", num_workers=num_workers, use_feature_cache=use_feature_cache):
+        if pitches is None:
+            continue
+        yield from pitch_chunks(pitches, chunk_size).astype(np.int64)
+
+
+def note_windows(dataset_name="ADL", max_sequence_length=64, num_workers=1, use_feature_cache=True):
+    """
+    Stream (pitch, delay, duration) sequences as each file is parsed, without building the whole dataset in memory
+    Args:
+        dataset_name (str): dataset name, use keys of DATASET_INFO
+        max_sequence_length (int): number of notes per song, shorter songs are skipped
+        num_workers (int): number of parsing processes, 1 parses serially, None uses all cores
+        use_feature_cache (bool): only parse files missing from the per-file feature cache
+    Yields:
+        np.ndarray: float64 array of shape (max_sequence_length, 3)
+    """
+    paths = get_all_files(dataset_name=dataset_name)
+    for _, notes in iter_features(paths, "note", num_workers=num_workers, use_feature_cache=use_feature_cache):
+        if notes is None:
+            continue
+        notes = note_sequence(notes, max_sequence_length)
+        if notes is not None:
+            yield notes
+
+
+def pitch_tf_dataset(dataset_name="ADL", chunk_size=CHUNK_SIZE, use_feature_cache=True):
+    """
+    tf.data pipeline over pitch_windows, training can start while the corpus is still being parsed
+    Files are parsed serially: the generator runs in a tf.data thread, where forking a worker pool is unsafe.
+    Parse the corpus with num_workers beforehand (e.g. preprocess_corpus) to fill the feature cache in parallel.
+    Returns:
+        tf.data.Dataset: elements of shape (chunk_size, 1) and dtype int64
+    """
+    import tensorflow as tf
+    return tf.data.Dataset.from_generator(
+        lambda: pitch_windows(dataset_name, chunk_size, num_workers=1, use_feature_cache=use_feature_cache),
+        output_signature=tf.TensorSpec(shape=(chunk_size, 1), dtype=tf.int64))
+
+
+def note_tf_dataset(dataset_name="ADL", max_sequence_length=64, use_feature_cache=True):
+    """
+    tf.data pipeline over note_windows, training can start while the corpus is still being parsed
+    Files are parsed serially: the generator runs in a tf.data thread, where forking a worker pool is unsafe.
+    Parse the corpus with num_workers beforehand (e.g. preprocess_corpus) to fill the feature cache in parallel.
+    Returns:
+        tf.data.Dataset: elements of shape (max_sequence_length, 3) and dtype float64
+    """
+    import tensorflow as tf
+    return tf.data.Dataset.from_generator(
+        lambda: note_windows(dataset_name, max_sequence_length, num_workers=1,
+                             use_feature_cache=use_feature_cache),
+        output_signature=tf.TensorSpec(shape=(max_sequence_length, 3), dtype=tf.float64))
+
+
 def split_chunks(to_split, chunk_size):
     """
     Yield successive n-sized chunks from a list
@@ -0,0 +1,125 @@
+import fnmatch
+import json
+import os
+import random
+
+from data.feature_cache import write_json
+
+
+def match_name(name, pattern):
+    """
+    Match one path component the way glob.glob does (non-recursive, hidden names need an explicit dot)
+    Args:
+        name (str): file or directory name
+        pattern (str): one component of a glob pattern, "**" behaves like "*"
+    Returns:
+        bool: whether the name matches
+    """
+    if name.startswith(".") and not pattern.startswith("."):
+        return False
+    return fnmatch.fnmatch(name, pattern.replace("**", "*"))
+
+
+class FileManifest:
+    def __init__(self, root, pattern, manifest_path):
+        """
+        Persistent listing of the files matching a glob pattern under a dataset root
+        Every visited directory is stored with its mtime, so a refresh only lists the directories that changed
+        and merely stats the others.
+        Args:
+            root (str): dataset root directory
+            pattern (str): glob pattern relative to root, e.g. "*/*/*/*/*.mid"
+            manifest_path (str): JSON file the manifest is persisted to
+        """
+        self.root = root
+        self.pattern = pattern
+        self.parts = pattern.split("/")
+        self.manifest_path = manifest_path
+        self.dirs = {}
+        self.files = []
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+            if manifest["root"] == root and manifest["pattern"] == pattern:
+                self.dirs = manifest["dirs"]
+                self.files = self.collect()
+
+    @property
+    def built(self):
+        return bool(self.dirs)
+
+    @property
+    def paths(self):
+        return [path for path, _, _ in self.files]
+
+    def __len__(self):
+        return len(self.files)
+
+    def refresh(self):
+        """
+        Bring the manifest up to date with the file system and persist it
+        Returns:
+            FileManifest: self
+        """
+        dirs = {}
+        self.scan("", 0, dirs)
+        changed = dirs != self.dirs
+        self.dirs = dirs
+        self.files = self.collect()
+        if changed:
+            os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+            write_json(self.manifest_path, {"root": self.root, "pattern": self.pattern, "dirs": self.dirs})
+        return self
+
+    def scan(self, relative_dir, depth, dirs):
+        path = os.path.join(self.root, relative_dir) if relative_dir else self.root
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+        is_leaf = depth == len(self.parts) - 1
+        entry = self.dirs.get(relative_dir)
+        if entry is None or entry["mtime"] != mtime:
+            entry = {"mtime": mtime, "dirs": [], "files": []}
+            with os.scandir(path) as it:
+                for dir_entry in it:
+                    if dir_entry.is_dir():
+                        entry["dirs"].append(dir_entry.name)
+                    elif is_leaf and dir_entry.is_file() and match_name(dir_entry.name, self.parts[-1]):
+                        stat = dir_entry.stat()
+                        entry["files"].append([dir_entry.name, stat.st_size, stat.st_mtime_ns])
+            entry["dirs"].sort()
+            entry["files"].sort()
+        dirs[relative_dir] = entry
+        if is_leaf:
+            return
+        for name in entry["dirs"]:
+            if match_name(name, self.parts[depth]):
+                self.scan(os.path.join(relative_dir, name) if relative_dir else name, depth + 1, dirs)
+
+    def collect(self):
+        """
+        Returns:
+            List((str, int, int)): (path, size, mtime) of every matching file, sorted by path
+        """
+        leaf_depth = len(self.parts) - 1
+        files = []
+        for relative_dir, entry in self.dirs.items():
+            depth = len(relative_dir.replace("\\", "/").split("/")) if relative_dir else 0
+            if depth != leaf_depth:
+                continue
+            directory = os.path.join(self.root, relative_dir) if relative_dir else self.root
+            for name, size, mtime in entry["files"]:
+                files.append((os.path.join(directory, name), size, mtime))
+        files.sort()
+        return files
+
+    def sample(self, k=1):
+        """
+        Pick random files without listing the dataset again
+        Args:
+            k (int): number of files
+        Returns:
+            List(str): k distinct file paths
+        """
+        return [path for path, _, _ in random.sample(self.files, k)]
@@ -0,0 +1,346 @@
+"""
+Minimal MIDI note extractor that skips building full PrettyMIDI objects
+
+Only note on/off, program change and set tempo events are interpreted. Everything else (key signatures, control
+changes, lyrics, ...) is skipped byte-wise, so files that pretty_midi rejects for metadata reasons are still read.
+Notes come out in the same order and with the same times as concatenating pretty_midi's instrument note lists.
+"""
+import struct
+import time
+from collections import defaultdict
+
+import numpy as np
+
+# pretty_midi refuses files longer than this
+MAX_TICK = 1e7
+
+# Number of data bytes following a status byte
+CHANNEL_DATA_LENGTHS = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2}
+SYSTEM_DATA_LENGTHS = {0xF1: 1, 0xF2: 2, 0xF3: 1, 0xF6: 0, 0xF8: 0, 0xFA: 0, 0xFB: 0, 0xFC: 0, 0xFE: 0}
+
+
+class MidiParseError(ValueError):
+    """ The file is not a well-formed standard MIDI file """
+
+
+class UnsupportedMidiError(MidiParseError):
+    """ The file is valid but uses a feature this extractor does not handle (e.g. SMPTE time division) """
+
+
+class MidiNotes:
+    def __init__(self, pitch, velocity, start, end, instrument, programs):
+        """
+        Notes of a MIDI file as parallel arrays, grouped by instrument like PrettyMIDI.instruments
+        Args:
+            pitch (np.ndarray): int16 pitches
+            velocity (np.ndarray): int16 velocities
+            start (np.ndarray): float64 start times in seconds
+            end (np.ndarray): float64 end times in seconds
+            instrument (np.ndarray): int32 index of each note's instrument
+            programs (List(int)): MIDI program of each instrument
+        """
+        self.pitch = pitch
+        self.velocity = velocity
+        self.start = start
+        self.end = end
+        self.instrument = instrument
+        self.programs = programs
+
+    def __len__(self):
+        return len(self.pitch)
+
+
+def _read_variable_int(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+
+def _read_track(data, pos, end, track_index, tempos, closed, instrument_ids):
+    """
+    Walk the events of one track chunk, appending closed notes and (for the first track) tempo changes
+    Returns:
+        int: absolute tick of the last event, None if the track has no events
+    """
+    tick = 0
+    last_tick = None
+    last_status = None
+    programs = [0] * 16
+    open_notes = defaultdict(list)
+    while pos != end:
+        if pos > end:
+            raise MidiParseError("event runs past the end of its track")
+        delta, pos = _read_variable_int(data, pos)
+        tick += delta
+        last_tick = tick
+        status = data[pos]
+        pos += 1
+        running = status < 0x80
+        if running:
+            if last_status is None:
+                raise MidiParseError("running status without last status")
+            status = last_status
+        elif status != 0xFF:
+            # Meta messages don't set running status
+            last_status = status
+
+        if status == 0xFF:
+            meta_type = data[pos]
+            length, pos = _read_variable_int(data, pos + 1)
+            if meta_type == 0x51 and track_index == 0:
+                if length < 3:
+                    raise MidiParseError("set_tempo event is too short")
+                tempos.append((tick, (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]))
+            pos += length
+            continue
+        if status == 0xF0 or status == 0xF7:
+            # Sysex, a running-status data byte in front of it is dropped
+            length, pos = _read_variable_int(data, pos)
+            pos += length
+            continue
+
+        if running:
+            pos -= 1
+        if status < 0xF0:
+            size = CHANNEL_DATA_LENGTHS[status & 0xF0]
+        elif status in SYSTEM_DATA_LENGTHS:
+            size = SYSTEM_DATA_LENGTHS[status]
+        else:
+            raise MidiParseError(f"undefined status byte 0x{status:02x}")
+        if pos + size > len(data):
+            raise MidiParseError("unexpected end of file")
+        for byte in data[pos:pos + size]:
+            if byte > 127:
+                raise MidiParseError("data byte must be in range 0..127")
+
+        kind = status & 0xF0
+        channel = status & 0x0F
+        if kind == 0x90 and data[pos + 1] > 0:
+            open_notes[(channel, data[pos])].append((tick, data[pos + 1]))
+        elif kind == 0x80 or kind == 0x90:
+            key = (channel, data[pos])
+            if key in open_notes:
+                # Same rule as pretty_midi: notes opened on this very tick stay open
+                to_close = [(start, velocity) for start, velocity in open_notes[key] if start != tick]
+                to_keep = [(start, velocity) for start, velocity in open_notes[key] if start == tick]
+                if to_close:
+                    instrument_key = (programs[channel], channel, track_index)
+                    if instrument_key not in instrument_ids:
+                        instrument_ids[instrument_key] = len(instrument_ids)
+                    instrument = instrument_ids[instrument_key]
+                    for start, velocity in to_close:
+                        closed.append((instrument, start, tick, data[pos], velocity))
+                if to_close and to_keep:
+                    open_notes[key] = to_keep
+                else:
+                    del open_notes[key]
+        elif kind == 0xC0:
+            programs[channel] = data[pos]
+        pos += size
+    return last_tick
+
+
+def _tick_scales(tempos, resolution):
+    # Mirrors PrettyMIDI._load_tempo_changes
+    tick_scales = [(0, 60.0 / (120.0 * resolution))]
+    for tick, tempo in tempos:
+        if tick == 0:
+            bpm = 6e7 / tempo
+            tick_scales = [(0, 60.0 / (bpm * resolution))]
+        else:
+            _, last_tick_scale = tick_scales[-1]
+            tick_scale = 60.0 / ((6e7 / tempo) * resolution)
+            if tick_scale != last_tick_scale:
+                tick_scales.append((tick, tick_scale))
+    return tick_scales
+
+
+def ticks_to_seconds(ticks, tick_scales):
+    """
+    Convert absolute ticks to seconds with the same float arithmetic as PrettyMIDI.get_tick_to_time
+    Args:
+        ticks (np.ndarray): int64 ticks
+        tick_scales (List((int, float))): (start tick, seconds per tick) of every tempo segment
+    Returns:
+        np.ndarray: float64 seconds
+    """
+    segment_starts = np.array([tick for tick, _ in tick_scales], dtype=np.int64)
+    scales = np.array([scale for _, scale in tick_scales], dtype=np.float64)
+    segment_times = np.zeros(len(tick_scales), dtype=np.float64)
+    for i in range(1, len(tick_scales)):
+        segment_times[i] = segment_times[i - 1] + scales[i - 1] * np.float64(segment_starts[i] - segment_starts[i - 1])
+    segment = np.searchsorted(segment_starts, ticks, side="right") - 1
+    return segment_times[segment] + scales[segment] * (ticks - segment_starts[segment]).astype(np.float64)
+
+
+def read_notes(path):
+    """
+    Read every note of a MIDI file straight into NumPy arrays
+    Args:
+        path (str): MIDI file path
+    Returns:
+        MidiNotes: notes in PrettyMIDI instrument order
+    Raises:
+        OSError: the file can't be read
+        MidiParseError: the file is malformed, UnsupportedMidiError if it should be read with pretty_midi instead
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        return _parse(data)
+    except (IndexError, KeyError, struct.error, ZeroDivisionError) as e:
+        raise MidiParseError(f"malformed MIDI file: {e!r}") from e
+
+
+def _parse(data):
+    if data[:4] != b"MThd":
+        raise MidiParseError("MThd not found. Probably not a MIDI file")
+    header_size = struct.unpack(">I", data[4:8])[0]
+    if header_size < 6:
+        raise MidiParseError("MIDI header is too short")
+    _, track_count, resolution = struct.unpack(">hhh", data[8:14])
+    if resolution < 0:
+        raise UnsupportedMidiError("SMPTE time division is not supported")
+
+    pos = 8 + header_size
+    tempos = []
+    closed = []
+    instrument_ids = {}
+    max_tick = 0
+    for track_index in range(track_count):
+        if len(data) < pos + 8:
+            raise MidiParseError("unexpected end of file")
+        if data[pos:pos + 4] != b"MTrk":
+            raise MidiParseError("no MTrk header at start of track")
+        size = struct.unpack(">I", data[pos + 4:pos + 8])[0]
+        pos += 8
+        last_tick = _read_track(data, pos, pos + size, track_index, tempos, closed, instrument_ids)
+        if last_tick is None:
+            raise MidiParseError("empty track")
+        max_tick = max(max_tick, last_tick + 1)
+        pos += size
+    if max_tick > MAX_TICK:
+        raise MidiParseError(f"MIDI file has a largest tick of {max_tick}, it is likely corrupt")
+
+    closed = np.array(closed, dtype=np.int64).reshape((-1, 5))
+    # Group by instrument (in creation order), keeping the order notes were closed in
+    closed = closed[np.argsort(closed[:, 0], kind="stable")]
+    tick_scales = _tick_scales(tempos, resolution)
+    programs = [program for (program, _, _), _ in sorted(instrument_ids.items(), key=lambda item: item[1])]
+    return MidiNotes(
+        pitch=closed[:, 3].astype(np.int16),
+        velocity=closed[:, 4].astype(np.int16),
+        start=ticks_to_seconds(closed[:, 1], tick_scales),
+        end=ticks_to_seconds(closed[:, 2], tick_scales),
+        instrument=closed[:, 0].astype(np.int32),
+        programs=programs)
+
+
+def pitch_data(notes):
+    """
+    Same output as load_data.extract_pitch_data, from fast-parsed notes
+    Returns:
+        np.ndarray: int16 array of shape (notes,)
+    """
+    return notes.pitch.astype(np.int16)
+
+
+def note_data(notes):
+    """
+    Same output as load_data.extract_note_data, from fast-parsed notes
+    Returns:
+        np.ndarray: float64 array of shape (notes, 3)
+    """
+    # The delay restarts from 0 at the first note of every instrument
+    prev_start = np.zeros(len(notes), dtype=np.float64)
+    prev_start[1:] = notes.start[:-1]
+    first_of_instrument = np.ones(len(notes), dtype=bool)
+    first_of_instrument[1:] = notes.instrument[1:] != notes.instrument[:-1]
+    prev_start[first_of_instrument] = 0
+    return np.stack([notes.pitch.astype(np.float64), notes.start - prev_start, notes.end - notes.start], axis=1)
+
+
+def compare_with_pretty_midi(paths):
+    """
+    Check that read_notes yields exactly the notes pretty_midi does
+    Args:
+        paths (List(str)): MIDI file paths
+    Returns:
+        List((str, str)): (path, reason) of every file whose output differs, files pretty_midi can't read are skipped
+    """
+    import pretty_midi as pm
+
+    mismatches = []
+    for path in paths:
+        try:
+            midi = pm.PrettyMIDI(path)
+        except Exception:
+            continue
+        expected = [note for instrument in midi.instruments for note in instrument.notes]
+        try:
+            notes = read_notes(path)
+        except UnsupportedMidiError:
+            continue
+        except Exception as e:
+            mismatches.append((path, f"fast extractor failed: {e!r}"))
+            continue
+        if len(notes) != len(expected):
+            mismatches.append((path, f"{len(notes)} notes instead of {len(expected)}"))
+            continue
+        for name in ("pitch", "velocity", "start", "end"):
+            if not np.array_equal(getattr(notes, name), np.array([getattr(note, name) for note in expected])):
+                mismatches.append((path, f"{name} differs"))
+                break
+    return mismatches
+
+
+def benchmark(paths):
+    """
+    Time pretty_midi against read_notes on the same files
+    Args:
+        paths (List(str)): MIDI file paths
+    Returns:
+        (float, float): seconds spent by pretty_midi and by read_notes
+    """
+    import pretty_midi as pm
+
+    start = time.perf_counter()
+    for path in paths:
+        try:
+            pm.PrettyMIDI(path)
+        except Exception:
+            pass
+    pretty_midi_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for path in paths:
+        try:
+            read_notes(path)
+        except Exception:
+            pass
+    fast_time = time.perf_counter() - start
+    return pretty_midi_time, fast_time
+
+
+if __name__ == "__main__":
+    import random
+    import sys
+
+    from data.load_data import get_all_files
+
+    dataset_name = sys.argv[1] if len(sys.argv) > 1 else "ADL"
+    all_paths = get_all_files(dataset_name=dataset_name)
+    sample = random.Random(2022).sample(all_paths, min(200, len(all_paths)))
+
+    print(f"Comparing {len(sample)} files from {dataset_name} against pretty_midi...")
+    for mismatch_path, reason in compare_with_pretty_midi(sample):
+        print(f">> MISMATCH {mismatch_path}: {reason}")
+
+    pretty_midi_seconds, fast_seconds = benchmark(sample)
+    print(f"pretty_midi: {len(sample) / pretty_midi_seconds:.1f} files/s, "
+          f"fast extractor: {len(sample) / fast_seconds:.1f} files/s "
+          f"({pretty_midi_seconds / fast_seconds:.1f}x speedup)")
@@ -0,0 +1,81 @@
+import os
+import time
+from multiprocessing import Pool
+
+
+class Progress:
+    def __init__(self, total, report_every=5.0, label="files"):
+        """
+        Periodically prints how many items have been processed and the throughput
+        Args:
+            total (int): total number of items
+            report_every (float): seconds between two reports, None to stay quiet
+            label (str): what the items are called in the report
+        """
+        self.total = total
+        self.report_every = report_every
+        self.label = label
+        self.done = 0
+        self.start_time = time.time()
+        self.last_report = self.start_time
+
+    def rate(self):
+        elapsed = time.time() - self.start_time
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def update(self, count=1):
+        self.done += count
+        if self.report_every is None:
+            return
+        now = time.time()
+        if now - self.last_report >= self.report_every:
+            self.last_report = now
+            self.report()
+
+    def report(self):
+        print(f">> {self.done}/{self.total} {self.label} ({self.rate():.1f} {self.label}/s)")
+
+    def finish(self):
+        if self.report_every is not None:
+            print(f">> Done: {self.done} {self.label} in {time.time() - self.start_time:.1f}s "
+                  f"({self.rate():.1f} {self.label}/s)")
+
+
+def resolve_workers(num_workers):
+    """
+    Normalize a worker count, None or 0 means one worker per CPU core
+    Args:
+        num_workers (int): requested number of workers
+    Returns:
+        int: number of workers to use, at least 1
+    """
+    if not num_workers:
+        return os.cpu_count() or 1
+    return max(1, int(num_workers))
+
+
+def imap_ordered(function, items, num_workers=1, chunk_size=8, report_every=5.0, label="files"):
+    """
+    Map a function over items with a pool of worker processes, yielding results in input order
+    Args:
+        function (callable): module-level (picklable) function applied to each item
+        items (list): inputs, e.g. MIDI file paths
+        num_workers (int): number of worker processes, 1 runs serially in this process, None uses all cores
+        chunk_size (int): number of items handed to a worker at a time
+        report_every (float): seconds between progress reports, None to stay quiet
+        label (str): what the items are called in progress reports
+    Yields:
+        the result of function(item) for each item, in the same order as items
+    """
+    num_workers = resolve_workers(num_workers)
+    progress = Progress(len(items), report_every=report_every, label=label)
+    if num_workers == 1:
+        for item in items:
+            yield function(item)
+            progress.update()
+    else:
+        with Pool(processes=num_workers) as pool:
+            for result in pool.imap(function, items, chunksize=chunk_size):
+                yield result
+                progress.update()
+    progress.finish()
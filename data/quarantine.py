@@ -0,0 +1,79 @@
+import json
+import os
+
+from data.feature_cache import file_fingerprint, write_json
+
+
+class Quarantine:
+    def __init__(self, path):
+        """
+        Persistent record of MIDI files that failed to parse, so they are not parsed again until they change
+        Args:
+            path (str): JSON file the records are persisted to
+        """
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.records = json.load(f)
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, path):
+        return self.is_quarantined(path)
+
+    def is_quarantined(self, path):
+        """
+        Check whether a file is quarantined, only quarantined files are stat'ed
+        Args:
+            path (str): file path
+        Returns:
+            bool: True if the file failed before and did not change since
+        """
+        record = self.records.get(path)
+        if record is None:
+            return False
+        try:
+            mtime, size = file_fingerprint(path)
+        except OSError:
+            return True
+        if record["mtime"] == mtime and record["size"] == size:
+            return True
+        # The file changed, give it another chance
+        del self.records[path]
+        self.dirty = True
+        return False
+
+    def reason(self, path):
+        record = self.records.get(path)
+        return record["reason"] if record is not None else None
+
+    def add(self, path, reason):
+        """
+        Quarantine a file
+        Args:
+            path (str): file path
+            reason (str): why parsing failed
+        """
+        try:
+            mtime, size = file_fingerprint(path)
+        except OSError:
+            mtime, size = None, None
+        self.records[path] = {"mtime": mtime, "size": size, "reason": reason}
+        self.dirty = True
+
+    def filter(self, paths):
+        """
+        Returns:
+            List(str): the paths that are not quarantined
+        """
+        return [path for path in paths if not self.is_quarantined(path)]
+
+    def save(self):
+        """ Persist the records """
+        if self.dirty:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            write_json(self.path, self.records)
+            self.dirty = False
@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class RaggedArray:
+    def __init__(self, values, offsets):
+        """
+        Variable-length songs stored as one flat array of notes plus song boundaries
+        Song i is values[offsets[i]:offsets[i + 1]], nothing is padded and nothing is dropped.
+        Args:
+            values (np.ndarray): notes of every song back to back, shape (notes, *note_shape)
+            offsets (np.ndarray): int64 array of shape (songs + 1,), starting at 0 and ending at len(values)
+        """
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @staticmethod
+    def from_arrays(arrays, dtype=None, note_shape=()):
+        """
+        Pack a list of per-song arrays
+        Args:
+            arrays (List(np.ndarray)): one array of shape (notes, *note_shape) per song
+            dtype (np.dtype): dtype of the packed values, defaults to the dtype of the arrays
+            note_shape (tuple): shape of one note, only used to shape the values when there are no songs
+        Returns:
+            RaggedArray: packed songs
+        """
+        lengths = [len(array) for array in arrays]
+        offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64)
+        values = np.concatenate(arrays) if arrays else np.empty((0, *note_shape), dtype=dtype)
+        if dtype is not None:
+            values = values.astype(dtype, copy=False)
+        return RaggedArray(values, offsets)
+
+    @staticmethod
+    def exists(root):
+        return os.path.exists(f"{root}/offsets.npy") and os.path.exists(f"{root}/values.npy")
+
+    @staticmethod
+    def load(root, mmap_mode="r"):
+        """
+        Load songs saved with RaggedArray.save
+        Args:
+            root (str): directory holding values.npy and offsets.npy
+            mmap_mode (str): passed to np.load, None reads everything into memory
+        Returns:
+            RaggedArray: loaded songs
+        """
+        return RaggedArray(np.load(f"{root}/values.npy", mmap_mode=mmap_mode), np.load(f"{root}/offsets.npy"))
+
+    def save(self, root):
+        os.makedirs(root, exist_ok=True)
+        for name, array in (("values", self.values), ("offsets", self.offsets)):
+            temp_path = f"{root}/{name}.npy.tmp"
+            with open(temp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(temp_path, f"{root}/{name}.npy")
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """ Song at an index, as a view into values """
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def window_starts(self, length, shift=1):
+        """
+        Start positions (into values) of every window that fits inside a single song
+        Args:
+            length (int): number of notes per window
+            shift (int): distance between two consecutive windows of a song, length gives non-overlapping chunks
+        Returns:
+            np.ndarray: int64 array of start positions, ordered by song then position
+        """
+        counts = np.maximum((self.lengths - length) // shift + 1, 0)
+        total = int(counts.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64)
+        first_window = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        song_starts = np.repeat(self.offsets[:-1], counts)
+        window_index = np.arange(total, dtype=np.int64) - np.repeat(first_window, counts)
+        return song_starts + window_index * shift
+
+    def window_view(self, length):
+        """
+        Zero-copy view of every length-sized window over values, index it with window_starts
+        Args:
+            length (int): number of notes per window
+        Returns:
+            np.ndarray: read-only view of shape (len(values) - length + 1, length, *note_shape), laid out like
+                take_windows
+        """
+        # sliding_window_view appends the window axis last, move it in front of the note axes
+        return np.moveaxis(sliding_window_view(self.values, length, axis=0), -1, 1)
+
+    def take_windows(self, starts, length):
+        """
+        Copy out a batch of windows
+        Args:
+            starts (np.ndarray): window start positions from window_starts
+            length (int): number of notes per window
+        Returns:
+            np.ndarray: array of shape (len(starts), length, *note_shape)
+        """
+        return self.values[np.asarray(starts)[:, None] + np.arange(length)]
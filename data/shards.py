@@ -0,0 +1,201 @@
+import json
+import os
+
+import numpy as np
+
+from data.feature_cache import write_json
+
+INDEX_FILE = "index.json"
+
+
+class ShardWriter:
+    def __init__(self, root, dtype, row_shape, shard_rows=65536, shards=None):
+        """
+        Write rows of a fixed dtype and shape into .npy shards plus an index file
+        Any dataset previously written to the same directory is replaced, except for the shards passed in.
+        Args:
+            root (str): dataset directory, created if missing
+            dtype (np.dtype): dtype of every shard
+            row_shape (tuple): shape of one row, e.g. (CHUNK_SIZE, 1)
+            shard_rows (int): number of rows per shard
+            shards (List(dict)): {"file", "rows"} records of already written shards to keep and append to
+        """
+        self.root = root
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.shard_rows = shard_rows
+        self.shards = list(shards or [])
+        self.buffer = []
+        self.buffered_rows = 0
+        os.makedirs(root, exist_ok=True)
+        kept = {shard["file"] for shard in self.shards}
+        for name in os.listdir(root):
+            if name.startswith("shard_") and name not in kept:
+                os.remove(f"{root}/{name}")
+        self.write_index()
+
+    def append(self, rows):
+        """
+        Add rows to the dataset, full shards are written out as soon as they are complete
+        Args:
+            rows (np.ndarray): array of shape (n, *row_shape)
+        """
+        rows = np.asarray(rows, dtype=self.dtype).reshape((-1,) + self.row_shape)
+        if len(rows) == 0:
+            return
+        self.buffer.append(rows)
+        self.buffered_rows += len(rows)
+        if self.buffered_rows >= self.shard_rows:
+            rows = np.concatenate(self.buffer)
+            full = len(rows) // self.shard_rows * self.shard_rows
+            for start in range(0, full, self.shard_rows):
+                self.write_shard(rows[start:start + self.shard_rows])
+            self.buffer = [rows[full:]]
+            self.buffered_rows = len(rows) - full
+
+    def flush(self):
+        """ Write the buffered rows as a (possibly short) shard """
+        if self.buffered_rows:
+            self.write_shard(np.concatenate(self.buffer))
+        self.buffer = []
+        self.buffered_rows = 0
+
+    def close(self):
+        self.flush()
+
+    def write_shard(self, rows):
+        self.add_shard(self.save_shard(rows))
+
+    def save_shard(self, rows):
+        """
+        Write the next shard file without publishing it in the index yet
+        Args:
+            rows (np.ndarray): array of shape (n, *row_shape)
+        Returns:
+            dict: {"file", "rows"} record to pass to add_shard
+        """
+        rows = np.asarray(rows, dtype=self.dtype).reshape((-1,) + self.row_shape)
+        name = f"shard_{len(self.shards):05d}.npy"
+        temp_path = f"{self.root}/{name}.tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, rows)
+        os.replace(temp_path, f"{self.root}/{name}")
+        return {"file": name, "rows": len(rows)}
+
+    def add_shard(self, shard):
+        """ Publish a shard written by save_shard, readers opening the dataset from now on will see it """
+        self.shards.append(shard)
+        self.write_index()
+
+    def write_index(self):
+        write_json(f"{self.root}/{INDEX_FILE}", {
+            "dtype": self.dtype.str,
+            "row_shape": list(self.row_shape),
+            "shards": self.shards
+        })
+
+
+class ShardedArray:
+    def __init__(self, root):
+        """
+        Read-only, array-like view over a sharded dataset
+        Shards are opened memory-mapped on first access, so only the rows that are actually indexed are read.
+        Args:
+            root (str): dataset directory written by ShardWriter
+        """
+        self.root = root
+        with open(f"{root}/{INDEX_FILE}", "r") as f:
+            index = json.load(f)
+        self.dtype = np.dtype(index["dtype"])
+        self.row_shape = tuple(index["row_shape"])
+        self.files = [shard["file"] for shard in index["shards"]]
+        self.offsets = np.concatenate([[0], np.cumsum([shard["rows"] for shard in index["shards"]])]).astype(np.int64)
+        self.opened = {}
+
+    @staticmethod
+    def exists(root):
+        return os.path.exists(f"{root}/{INDEX_FILE}")
+
+    @property
+    def shape(self):
+        return (len(self),) + self.row_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def shard(self, shard_id):
+        if shard_id not in self.opened:
+            self.opened[shard_id] = np.load(f"{self.root}/{self.files[shard_id]}", mmap_mode="r")
+        return self.opened[shard_id]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows = self[key[0]]
+            if np.isscalar(key[0]):
+                return rows[key[1:]]
+            return rows[(slice(None),) + key[1:]]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self[np.arange(start, stop, step)]
+            return self.read_range(start, stop)
+        if np.isscalar(key):
+            index = int(key)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError(f"index {key} is out of bounds for a dataset of {len(self)} rows")
+            shard_id = int(np.searchsorted(self.offsets, index, side="right")) - 1
+            return np.asarray(self.shard(shard_id)[index - self.offsets[shard_id]])
+        return self.take(np.asarray(key))
+
+    def read_range(self, start, stop):
+        """
+        Read the contiguous rows [start, stop)
+        Returns:
+            np.ndarray: array of shape (stop - start, *row_shape)
+        """
+        output = np.empty((max(0, stop - start),) + self.row_shape, dtype=self.dtype)
+        if stop <= start:
+            return output
+        first = int(np.searchsorted(self.offsets, start, side="right")) - 1
+        last = int(np.searchsorted(self.offsets, stop - 1, side="right")) - 1
+        for shard_id in range(first, last + 1):
+            shard_start = self.offsets[shard_id]
+            lo = max(start, shard_start)
+            hi = min(stop, self.offsets[shard_id + 1])
+            output[lo - start:hi - start] = self.shard(shard_id)[lo - shard_start:hi - shard_start]
+        return output
+
+    def take(self, indices):
+        """
+        Gather arbitrary rows, e.g. one shuffled batch
+        Args:
+            indices (np.ndarray): row indices, negative values count from the end
+        Returns:
+            np.ndarray: array of shape (*indices.shape, *row_shape)
+        """
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        flat = indices.astype(np.int64).ravel()
+        flat = np.where(flat < 0, flat + len(self), flat)
+        if len(flat) and (flat.min() < 0 or flat.max() >= len(self)):
+            raise IndexError(f"index out of bounds for a dataset of {len(self)} rows")
+        output = np.empty((len(flat),) + self.row_shape, dtype=self.dtype)
+        shard_ids = np.searchsorted(self.offsets, flat, side="right") - 1
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            output[mask] = self.shard(shard_id)[flat[mask] - self.offsets[shard_id]]
+        return output.reshape(indices.shape + self.row_shape)
+
+    def __iter__(self):
+        for shard_id in range(len(self.files)):
+            yield from self.shard(shard_id)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.read_range(0, len(self))
+        return data if dtype is None else data.astype(dtype)
@@ -9,18 +9,38 @@ import tensorflow as tf
 import numpy as np
 import miditoolkit
 import processing.modules as modules
+import os
 import pickle
+import sys
 import processing.utils as utils
 import time
 
+# resident memory of this process in MB, the peak on platforms without psutil, None if it cannot be measured
+def resident_memory_mb():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2 ** 20
+    except ImportError:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, KB elsewhere
+        return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+    except ImportError:
+        return None
+
+
 class NotezartTransformer(object):
     ########################################
     # initialize
     ########################################
-    def __init__(self, checkpoint, dataset_name, is_training=False):
+    def __init__(self, checkpoint, dataset_name, is_training=False, batch_size=None):
         # load dictionary
         self.dictionary_path = '{}/dictionary/dictionary_{}.pkl'.format(checkpoint, dataset_name)
         self.event2word, self.word2event = pickle.load(open(self.dictionary_path, 'rb'))
+        self.word_table = utils.WordTable(self.event2word)
+        self.decode_table = utils.DecodeTable(self.word2event)
         # model settings
         self.x_len = 512
         self.mem_len = 512
@@ -36,7 +56,10 @@ class NotezartTransformer(object):
         self.group_size = 5
         # load model
         self.is_training = is_training
-        if self.is_training:
+        if batch_size is not None:
+            # for generation, every row of a batch is an independent sample
+            self.batch_size = batch_size
+        elif self.is_training:
             self.batch_size = 4
         else:
             self.batch_size = 1
@@ -46,18 +69,29 @@ class NotezartTransformer(object):
     # load model
     ########################################
     def load_model(self, existing_model=None):
+        start_time = time.time()
         tf.compat.v1.disable_eager_execution()
-        # placeholders
+        # placeholders, targets are only needed for training
         self.x = tf.compat.v1.placeholder(tf.int32, shape=[self.batch_size, None])
-        self.y = tf.compat.v1.placeholder(tf.int32, shape=[self.batch_size, None])
-        self.mems_i = [tf.compat.v1.placeholder(tf.float32, [self.mem_len, self.batch_size, self.d_model]) for _ in range(self.n_layer)]
+        self.y = tf.compat.v1.placeholder(tf.int32, shape=[self.batch_size, None]) if self.is_training else None
+        # for generation, the memory of every layer holds its projected keys and values (see modules.transformer)
+        # and stays in local variables of the session, only the input words and the next logits are transferred
+        self.kv_cache = not self.is_training
+        if self.kv_cache:
+            with tf.compat.v1.variable_scope('generation'):
+                self.mem_vars = [tf.compat.v1.get_variable(
+                    'mem_{}'.format(i), [self.mem_len, self.batch_size, 2 * self.n_head * self.d_head],
+                    initializer=tf.zeros_initializer(), trainable=False,
+                    collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES]) for i in range(self.n_layer)]
+            self.mems_i = [m.read_value() for m in self.mem_vars]
+        else:
+            self.mems_i = [tf.compat.v1.placeholder(tf.float32, [self.mem_len, self.batch_size, self.d_model]) for _ in range(self.n_layer)]
         # model
-        self.global_step = tf.compat.v1.train.get_or_create_global_step()
         initializer = tf.compat.v1.initializers.random_normal(stddev=0.02, seed=None)
         proj_initializer = tf.compat.v1.initializers.random_normal(stddev=0.01, seed=None)
         with tf.compat.v1.variable_scope(tf.compat.v1.get_variable_scope()):
             xx = tf.transpose(self.x, [1, 0])
-            yy = tf.transpose(self.y, [1, 0])
+            yy = tf.transpose(self.y, [1, 0]) if self.is_training else None
             loss, self.logits, self.new_mem = modules.transformer(
                 dec_inp=xx,
                 target=yy,
@@ -84,23 +118,35 @@ class NotezartTransformer(object):
                 target_perms=None,
                 head_target=None,
                 untie_r=False,
-                proj_same_dim=True)
-        self.avg_loss = tf.reduce_mean(loss)
-        # vars
-        all_vars = tf.compat.v1.trainable_variables()
-        grads = tf.gradients(self.avg_loss, all_vars)
-        grads_and_vars = list(zip(grads, all_vars))
-        all_trainable_vars = tf.reduce_sum([tf.reduce_prod(v.shape) for v in tf.compat.v1.trainable_variables()])
-        # optimizer
-        decay_lr = tf.compat.v1.train.cosine_decay(
-            self.learning_rate,
-            global_step=self.global_step,
-            decay_steps=400000,
-            alpha=0.004)
-        optimizer = tf.compat.v1.train.AdamOptimizer(learning_rate=decay_lr)
-        self.train_op = optimizer.apply_gradients(grads_and_vars, self.global_step)
-        # saver
-        self.saver = tf.compat.v1.train.Saver()
+                proj_same_dim=True,
+                kv_cache=self.kv_cache)
+        if self.kv_cache:
+            # one step: the logits of the last position, the memory is updated in place
+            update_mems = [m.assign(new_m) for m, new_m in zip(self.mem_vars, self.new_mem)]
+            with tf.control_dependencies(update_mems):
+                self.next_logits = tf.identity(self.logits[-1])
+            self.reset_mems = tf.group([m.assign(tf.zeros_like(m)) for m in self.mem_vars])
+        if self.is_training:
+            self.global_step = tf.compat.v1.train.get_or_create_global_step()
+            self.avg_loss = tf.reduce_mean(loss)
+            # vars
+            all_vars = tf.compat.v1.trainable_variables()
+            grads = tf.gradients(self.avg_loss, all_vars)
+            grads_and_vars = list(zip(grads, all_vars))
+            all_trainable_vars = tf.reduce_sum([tf.reduce_prod(v.shape) for v in tf.compat.v1.trainable_variables()])
+            # optimizer
+            decay_lr = tf.compat.v1.train.cosine_decay(
+                self.learning_rate,
+                global_step=self.global_step,
+                decay_steps=400000,
+                alpha=0.004)
+            optimizer = tf.compat.v1.train.AdamOptimizer(learning_rate=decay_lr)
+            self.train_op = optimizer.apply_gradients(grads_and_vars, self.global_step)
+            # saver
+            self.saver = tf.compat.v1.train.Saver()
+        else:
+            # forward pass only: restore the model weights and ignore the optimizer state of the checkpoint
+            self.saver = tf.compat.v1.train.Saver(var_list=tf.compat.v1.global_variables())
         config = tf.compat.v1.ConfigProto(allow_soft_placement=True)
         config.gpu_options.allow_growth = True
         self.sess = tf.compat.v1.Session(config=config)
@@ -112,29 +158,55 @@ class NotezartTransformer(object):
             self.saver.restore(self.sess, existing_model)
         else:
             self.saver.restore(self.sess, self.checkpoint_path)
-
+        if self.kv_cache:
+            # zero the memory and project the positions of an incremental step once, with the restored weights
+            self.sess.run(tf.compat.v1.local_variables_initializer())
+            self.sess.run(tf.compat.v1.get_collection(modules.KV_CACHE_INIT))
+        memory = resident_memory_mb()
+        print('Model ready in {:.1f}s, resident memory {}'.format(
+            time.time() - start_time, 'unknown' if memory is None else '{:.0f} MB'.format(memory)))
 
     ########################################
     # temperature sampling
     ########################################
-    def temperature_sampling(self, logits, temperature, topk):
-        probs = np.exp(logits / temperature) / np.sum(np.exp(logits / temperature))
+    # logits: (n_token,) for one word or (batch, n_token) for one word per row
+    # topk: number of most likely words to sample from, topp: optional nucleus, the smallest set of those
+    # words whose probability reaches topp, rng: np.random.Generator, the global NumPy random state if None
+    def temperature_sampling(self, logits, temperature, topk, topp=None, rng=None):
+        logits = np.asarray(logits, dtype=np.float64)
+        single = logits.ndim == 1
+        logits = np.atleast_2d(logits)
         if topk == 1:
-            prediction = np.argmax(probs)
+            prediction = np.argmax(logits, axis=-1)
         else:
-            sorted_index = np.argsort(probs)[::-1]
-            candi_index = sorted_index[:topk]
-            candi_probs = [probs[i] for i in candi_index]
-            # normalize probs
-            candi_probs /= sum(candi_probs)
-            # choose by predicted probs
-            prediction = np.random.choice(candi_index, size=1, p=candi_probs)[0]
-        return prediction
+            rows = np.arange(len(logits))[:, None]
+            topk = min(topk, logits.shape[-1])
+            # topk candidates by partial selection, then sorted by decreasing probability
+            candi_index = np.argpartition(-logits, topk - 1, axis=-1)[:, :topk]
+            candi_logits = logits[rows, candi_index]
+            order = np.argsort(-candi_logits, axis=-1)
+            candi_index, candi_logits = candi_index[rows, order], candi_logits[rows, order]
+            # stable softmax over the candidates
+            candi_probs = np.exp((candi_logits - candi_logits[:, :1]) / temperature)
+            candi_probs /= candi_probs.sum(axis=-1, keepdims=True)
+            # last candidate each row may pick
+            last = np.full(len(logits), topk - 1)
+            if topp is not None:
+                # keep a candidate while the more likely ones sum to less than topp
+                keep = np.cumsum(candi_probs, axis=-1) - candi_probs < topp
+                candi_probs *= keep
+                last = keep.sum(axis=-1) - 1
+            # choose by predicted probs, the uniform draw is scaled to the mass left after top-p
+            candi_cumsum = np.cumsum(candi_probs, axis=-1)
+            uniform = (rng if rng is not None else np.random).random((len(logits), 1)) * candi_cumsum[:, -1:]
+            choice = np.minimum((candi_cumsum < uniform).sum(axis=-1), last)
+            prediction = candi_index[rows[:, 0], choice]
+        return prediction[0] if single else prediction
 
     ########################################
     # extract events for prompt continuation
     ########################################
-    def extract_events(self, input_path):
+    def extract_groups(self, input_path):
         note_items, tempo_items = utils.read_items(input_path)
         note_items = utils.quantize_items(note_items)
         max_time = note_items[-1].end
@@ -143,19 +215,40 @@ class NotezartTransformer(object):
             items = chord_items + tempo_items + note_items
         else:
             items = tempo_items + note_items
-        groups = utils.group_items(items, max_time)
+        return utils.group_items(items, max_time)
+
+    def extract_events(self, input_path):
+        groups = self.extract_groups(input_path)
         events = utils.item2event(groups)
         return events
 
+    # same tokens as extract_events, already mapped to words
+    def extract_words(self, input_path):
+        return np.concatenate([np.zeros(0, dtype=np.int64)] + list(self.iter_words(input_path)))
+
+    # words of a prompt file bar by bar, a bar is yielded as soon as it is tokenized (see utils.BarTokenizer)
+    def iter_words(self, input_path):
+        return utils.iter_file_words(input_path, self.word_table, chords='chord' in self.checkpoint_path)
+
     ########################################
     # generate
     ########################################
-    def generate(self, n_target_bar, temperature, topk, output_path, prompt=None):
-        # if prompt, load it. Or, random start
+    def generate(self, n_target_bar, temperature, topk, output_path, prompt=None, topp=None, seed=None):
+        # seeded generation draws everything from one generator, otherwise from the global NumPy random state
+        rng = np.random.default_rng(seed) if seed is not None else None
+        choice = rng.choice if rng is not None else np.random.choice
+        # initialize mem
+        if self.kv_cache:
+            self.sess.run(self.reset_mems)
+            batch_m = None
+        else:
+            batch_m = [np.zeros(m.shape.as_list(), dtype=np.float32) for m in self.mems_i]
+        # if prompt, feed it to the model bar by bar while the rest of the file is tokenized. Or, random start
         if prompt:
-            events = self.extract_events(prompt)
-            words = [[self.event2word['{}_{}'.format(e.name, e.value)] for e in events]]
-            words[0].append(self.event2word['Bar_None'])
+            for bar in self.iter_words(prompt):
+                _, batch_m = self.run_model(np.tile(bar, (self.batch_size, 1)), batch_m)
+            # every row continues the prompt from a new bar
+            words = [[self.event2word['Bar_None']] for _ in range(self.batch_size)]
         else:
             words = []
             for _ in range(self.batch_size):
@@ -165,67 +258,78 @@ class NotezartTransformer(object):
                     tempo_values = [v for k, v in self.event2word.items() if 'Tempo Value' in k]
                     chords = [v for k, v in self.event2word.items() if 'Chord' in k]
                     ws.append(self.event2word['Position_1/16'])
-                    ws.append(np.random.choice(chords))
+                    ws.append(choice(chords))
                     ws.append(self.event2word['Position_1/16'])
-                    ws.append(np.random.choice(tempo_classes))
-                    ws.append(np.random.choice(tempo_values))
+                    ws.append(choice(tempo_classes))
+                    ws.append(choice(tempo_values))
                 else:
                     tempo_classes = [v for k, v in self.event2word.items() if 'Tempo Class' in k]
                     tempo_values = [v for k, v in self.event2word.items() if 'Tempo Value' in k]
                     ws.append(self.event2word['Position_1/16'])
-                    ws.append(np.random.choice(tempo_classes))
-                    ws.append(np.random.choice(tempo_values))
+                    ws.append(choice(tempo_classes))
+                    ws.append(choice(tempo_values))
                 words.append(ws)
-        # initialize mem
-        batch_m = [np.zeros((self.mem_len, self.batch_size, self.d_model), dtype=np.float32) for _ in range(self.n_layer)]
+        start_time = time.time()
+        n_sampled = 0
         # generate
         original_length = len(words[0])
         initial_flag = 1
-        current_generated_bar = 0
-        while current_generated_bar < n_target_bar:
+        # every row is sampled independently and stops once it has n_target_bar bars
+        generated_bars = np.zeros(self.batch_size, dtype=int)
+        while (generated_bars < n_target_bar).any():
             # input
             if initial_flag:
-                temp_x = np.zeros((self.batch_size, original_length))
-                for b in range(self.batch_size):
-                    for z, t in enumerate(words[b]):
-                        temp_x[b][z] = t
+                temp_x = np.array(words)
                 initial_flag = 0
             else:
-                temp_x = np.zeros((self.batch_size, 1))
-                for b in range(self.batch_size):
-                    temp_x[b][0] = words[b][-1]
-            # prepare feed dict
-            feed_dict = {self.x: temp_x}
-            for m, m_np in zip(self.mems_i, batch_m):
-                feed_dict[m] = m_np
+                # finished rows keep feeding their last word, their predictions are dropped
+                temp_x = np.array([[ws[-1]] for ws in words])
             # model (prediction)
-            _logits, _new_mem = self.sess.run([self.logits, self.new_mem], feed_dict=feed_dict)
-            # sampling
-            _logit = _logits[-1, 0]
-            word = self.temperature_sampling(
-                logits=_logit,
+            _logits, batch_m = self.run_model(temp_x, batch_m)
+            # sampling, for the rows that are not finished
+            active = np.flatnonzero(generated_bars < n_target_bar)
+            sampled = self.temperature_sampling(
+                logits=_logits[active],
                 temperature=temperature,
-                topk=topk)
-            words[0].append(word)
-            # if bar event (only work for batch_size=1)
-            if word == self.event2word['Bar_None']:
-                current_generated_bar += 1
-            # re-new mem
-            batch_m = _new_mem
-        # write
-        if prompt:
+                topk=topk,
+                topp=topp,
+                rng=rng)
+            for b, word in zip(active, sampled.tolist()):
+                words[b].append(word)
+                if word == self.event2word['Bar_None']:
+                    generated_bars[b] += 1
+            n_sampled += len(active)
+        elapsed = time.time() - start_time
+        print('Generated {} tokens in {:.1f}s ({:.1f} tokens/s)'.format(n_sampled, elapsed, n_sampled / max(elapsed, 1e-9)))
+        # write, one file per row
+        for b in range(self.batch_size):
             utils.write_midi(
-                words=words[0][original_length:],
+                words=words[b][original_length:] if prompt else words[b],
                 word2event=self.word2event,
-                output_path=output_path,
-                prompt_path=None)
-        else:
-            utils.write_midi(
-                words=words[0],
-                word2event=self.word2event,
-                output_path=output_path,
+                table=self.decode_table,
+                output_path=self.sample_path(output_path, b),
                 prompt_path=None)
 
+    # logits of the last input word of every row, the memory moves on past temp_x
+    # batch_m is the memory without kv cache (None with it), returned updated
+    def run_model(self, temp_x, batch_m):
+        if self.kv_cache:
+            return self.sess.run(self.next_logits, feed_dict={self.x: temp_x}), None
+        # prepare feed dict
+        feed_dict = {self.x: temp_x}
+        for m, m_np in zip(self.mems_i, batch_m):
+            feed_dict[m] = m_np
+        _logits, _new_mem = self.sess.run([self.logits, self.new_mem], feed_dict=feed_dict)
+        # re-new mem
+        return _logits[-1], _new_mem
+
+    # output path of a row: output_path itself for a single sample, "<name>_<row><ext>" for a batch
+    def sample_path(self, output_path, index):
+        if self.batch_size == 1:
+            return output_path
+        root, ext = os.path.splitext(output_path)
+        return '{}_{}{}'.format(root, index, ext)
+
     ########################################
     # prepare training data
     ########################################
@@ -248,7 +352,10 @@ class NotezartTransformer(object):
                         # you should handle it for your own purpose
                         print('something is wrong! {}'.format(e))
             all_words.append(words)
-        # to training data
+        return self.prepare_words(all_words)
+
+    # word sequences (e.g. from processing.tokenize_corpus) to training segments
+    def prepare_words(self, all_words):
         segments = []
         for words in all_words:
             pairs = []
@@ -6,13 +6,15 @@ import pretty_midi
 import tensorflow as tf
 from matplotlib import pyplot as plt
 
-from data.load_data import load_pitch_data
+from data.load_data import CHUNK_SIZE, load_pitch_data, pitch_tf_dataset
 
 ###################
 # GLOBAL SETTINGS #
 ###################
 LOAD_DATA_USE_CACHE = True
 LOAD_DATA_SIZE = 640_000
+# Parse MIDI files on the fly and start training before the whole corpus is loaded
+LOAD_DATA_STREAMING = False
 
 TRAINING_CALLBACKS = [
     tf.keras.callbacks.ModelCheckpoint(
@@ -28,30 +30,48 @@ TRAINING_CALLBACKS = [
 MAX_TRAIN_EPOCHS = 100
 
 
-def create_sequences(dataset: tf.data.Dataset, seq_length: int, vocab_size=128) -> tf.data.Dataset:
-    """ Returns TF Dataset of sequence and label examples """
-    seq_length = seq_length + 1
+def split_labels(sequences, vocab_size=128):
+    """ Splits (..., seq_length + 1, 1) windows into normalized inputs and next-pitch labels """
+    inputs = sequences[..., :-1, :]
+    labels = {"pitch": sequences[..., -1, 0]}
+    return inputs / vocab_size, labels
 
-    # Take 1 extra for the labels
-    windows = dataset.window(seq_length, shift=1, stride=1, drop_remainder=True)
 
-    # `flat_map` flattens the" dataset of datasets" into a dataset of tensors
-    flatten = lambda x: x.batch(seq_length, drop_remainder=True)
-    sequences = windows.flat_map(flatten)
+def create_sequences(notes: np.ndarray, seq_length: int, vocab_size=128, batch_size=None, shuffle=False,
+                     seed=None) -> tf.data.Dataset:
+    """
+    Returns TF Dataset of sequence and label examples
+    Windows are never materialized: the dataset iterates over window start indices (permuted each epoch when
+    shuffling) and gathers a whole batch of windows from the note array at once. Shuffling therefore holds
+    O(windows) int64 indices instead of O(windows * seq_length) notes.
+    """
+    window_count = len(notes) - seq_length
+    notes = tf.constant(notes)
+    offsets = tf.range(seq_length + 1, dtype=tf.int64)
+
+    starts = tf.data.Dataset.range(window_count)
+    if shuffle:
+        starts = starts.shuffle(window_count, seed=seed, reshuffle_each_iteration=True)
+    if batch_size is not None:
+        starts = starts.batch(batch_size, drop_remainder=True)
 
-    # Normalize note pitch
-    def scale_pitch(x):
-        return x / vocab_size
+    # Take 1 extra for the labels
+    def gather_windows(start):
+        return split_labels(tf.gather(notes, start[..., None] + offsets), vocab_size)
 
-    # Split the labels
-    def split_labels(sequences):
-        inputs = sequences[:-1]
-        labels_dense = sequences[-1]
-        labels = {key: labels_dense[i] for i, key in enumerate(["pitch"])}
+    return starts.map(gather_windows, num_parallel_calls=tf.data.AUTOTUNE)
 
-        return scale_pitch(inputs), labels
 
-    return sequences.map(split_labels, num_parallel_calls=tf.data.AUTOTUNE)
+def frame_sequences(dataset: tf.data.Dataset, seq_length: int, vocab_size=128, block_size=65_536) -> tf.data.Dataset:
+    """
+    Returns TF Dataset of sequence and label examples from a stream of notes
+    The stream is cut into blocks that are framed in one vectorized op, windows crossing two blocks are skipped.
+    """
+    blocks = dataset.batch(block_size)
+    windows = blocks.map(lambda block: tf.signal.frame(block, seq_length + 1, 1, axis=0),
+                         num_parallel_calls=tf.data.AUTOTUNE)
+    return windows.unbatch().map(lambda window: split_labels(window, vocab_size),
+                                 num_parallel_calls=tf.data.AUTOTUNE)
 
 
 def build_model(seq_length, learning_rate=0.005):
@@ -118,37 +138,40 @@ if __name__ == "__main__":
     tf.random.set_seed(seed)
     np.random.seed(seed)
 
-    # Load data
-    print("Loading data...")
-    dataset = load_pitch_data(use_cache=LOAD_DATA_USE_CACHE).reshape((1_406_848, 1))[:LOAD_DATA_SIZE]
-    print(f">> {dataset.shape}")
-    note_count = len(dataset)
-
-    # Create tensorflow dataset
-    print("Creating tensorflow dataset...")
-    notes_dataset = tf.data.Dataset.from_tensor_slices(dataset)
-    print(f">> {notes_dataset.element_spec}")
-
-    # Create sequences
     seq_length = 64
     vocab_size = 128  # range of pitches supported in pretty_midi
-    sequence_dataset = create_sequences(notes_dataset, seq_length, vocab_size)
-    print(sequence_dataset.element_spec)
-
-    # Preview sequence
-    for seq, target in sequence_dataset.take(1):
-        print('sequence shape:', seq.shape)
-        print('sequence elements (first 5):', seq[0: 5])
-        print('target:', target)
-
-    # Prepare training dataset
     batch_size = 512
-    buffer_size = note_count - seq_length  # the number of items in the dataset
-    train_dataset = (sequence_dataset
-                     .shuffle(buffer_size)
-                     .batch(batch_size, drop_remainder=True)
-                     .cache()
-                     .prefetch(tf.data.experimental.AUTOTUNE))
+
+    if LOAD_DATA_STREAMING:
+        # Create tensorflow dataset
+        print("Creating streaming tensorflow dataset...")
+        notes_dataset = pitch_tf_dataset().unbatch().take(LOAD_DATA_SIZE)
+        print(f">> {notes_dataset.element_spec}")
+
+        # Create sequences
+        sequence_dataset = frame_sequences(notes_dataset, seq_length, vocab_size)
+        train_dataset = (sequence_dataset
+                         .shuffle(65_536)
+                         .batch(batch_size, drop_remainder=True)
+                         .prefetch(tf.data.experimental.AUTOTUNE))
+    else:
+        # Load data
+        print("Loading data...")
+        # Only the shards holding the first LOAD_DATA_SIZE notes are read from disk
+        pitch_chunks = load_pitch_data(use_cache=LOAD_DATA_USE_CACHE, lazy=True)
+        dataset = pitch_chunks[:LOAD_DATA_SIZE // CHUNK_SIZE].reshape((-1, 1))
+        print(f">> {dataset.shape}")
+
+        # Create sequences
+        train_dataset = (create_sequences(dataset, seq_length, vocab_size, batch_size=batch_size, shuffle=True)
+                         .prefetch(tf.data.experimental.AUTOTUNE))
+    print(train_dataset.element_spec)
+
+    # Preview the first sequence of a batch
+    for seq, target in train_dataset.take(1):
+        print('sequence shape:', seq.shape[1:])
+        print('sequence elements (first 5):', seq[0, 0: 5])
+        print('target:', target["pitch"][0])
 
     # Build model
     model = build_model(seq_length)
@@ -0,0 +1,372 @@
+# Micro-benchmarks for the tokenizer in processing.utils
+# Each benchmark checks the optimized code against a copy of the original implementation before timing both.
+# Run with: python -m processing.benchmarks
+
+import copy
+import time
+
+import numpy as np
+
+import processing.utils as utils
+
+
+# best wall time of function(setup()) over several runs, setup is not timed
+def timeit(function, setup=lambda: None, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        argument = setup()
+        start = time.perf_counter()
+        function(argument)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(name, reference_time, optimized_time):
+    print('{}: reference {:.2f} ms, optimized {:.2f} ms ({:.1f}x speedup)'.format(
+        name, reference_time * 1000, optimized_time * 1000, reference_time / optimized_time))
+
+
+def random_note_items(n_notes=10_000, seed=2022):
+    rng = np.random.default_rng(seed)
+    starts = np.sort(rng.integers(0, n_notes * 60, n_notes))
+    durations = rng.integers(1, 1920, n_notes)
+    return [utils.Item(name='Note', start=int(start), end=int(start + duration),
+                       velocity=int(rng.integers(1, 128)), pitch=int(rng.integers(21, 109)))
+            for start, duration in zip(starts, durations)]
+
+
+#############################################################################################
+# QUANTIZE
+#############################################################################################
+def reference_quantize_items(items, ticks=120):
+    grids = np.arange(0, items[-1].start, ticks, dtype=int)
+    for item in items:
+        index = np.argmin(abs(grids - item.start))
+        shift = grids[index] - item.start
+        item.start += shift
+        item.end += shift
+    return items
+
+
+def benchmark_quantize(n_notes=10_000):
+    items = random_note_items(n_notes)
+    expected = reference_quantize_items(copy.deepcopy(items))
+    actual = utils.quantize_items(copy.deepcopy(items))
+    assert [(i.start, i.end) for i in expected] == [(i.start, i.end) for i in actual], 'quantize_items differs'
+    report('quantize_items ({} notes)'.format(n_notes),
+           timeit(reference_quantize_items, lambda: copy.deepcopy(items), repeat=1),
+           timeit(utils.quantize_items, lambda: copy.deepcopy(items)))
+
+
+#############################################################################################
+# GROUP
+#############################################################################################
+def reference_group_items(items, max_time, ticks_per_bar=utils.DEFAULT_RESOLUTION * 4):
+    items.sort(key=lambda x: x.start)
+    downbeats = np.arange(0, max_time + ticks_per_bar, ticks_per_bar)
+    groups = []
+    for db1, db2 in zip(downbeats[:-1], downbeats[1:]):
+        insiders = []
+        for item in items:
+            if (item.start >= db1) and (item.start < db2):
+                insiders.append(item)
+        overall = [db1] + insiders + [db2]
+        groups.append(overall)
+    return groups
+
+
+def benchmark_group(n_notes=20_000):
+    items = utils.quantize_items(random_note_items(n_notes))
+    max_time = items[-1].end
+    expected = reference_group_items(list(items), max_time)
+    actual = utils.group_items(list(items), max_time)
+    assert expected == actual, 'group_items differs'
+    report('group_items ({} notes, {} bars)'.format(n_notes, len(actual)),
+           timeit(lambda _: reference_group_items(list(items), max_time), repeat=1),
+           timeit(lambda _: utils.group_items(list(items), max_time)))
+
+
+#############################################################################################
+# TEMPO
+#############################################################################################
+def reference_expand_tempos(tempo_items):
+    max_tick = tempo_items[-1].start
+    existing_ticks = {item.start: item.pitch for item in tempo_items}
+    output = []
+    for tick in np.arange(0, max_tick + 1, utils.DEFAULT_RESOLUTION):
+        pitch = existing_ticks[tick] if tick in existing_ticks else output[-1].pitch
+        output.append(utils.Item(name='Tempo', start=tick, end=None, velocity=None, pitch=pitch))
+    return output
+
+
+def benchmark_tempos(n_changes=20_000, seed=2022):
+    rng = np.random.default_rng(seed)
+    # a dense tempo map: changes on beats, between beats and repeated at the same tick
+    on_beat = rng.integers(0, n_changes, n_changes) * utils.DEFAULT_RESOLUTION
+    anywhere = rng.integers(0, n_changes * utils.DEFAULT_RESOLUTION, n_changes)
+    times = np.sort(np.concatenate([[0], np.where(rng.random(n_changes) < 0.5, on_beat, anywhere)]))
+    tempo_items = [utils.Item(name='Tempo', start=int(time), end=None, velocity=None, pitch=int(tempo))
+                   for time, tempo in zip(times, rng.integers(40, 200, len(times)))]
+    times, tempos = [item.start for item in tempo_items], [item.pitch for item in tempo_items]
+    expected = reference_expand_tempos(tempo_items)
+    actual = utils.expand_tempos(times, tempos)
+    assert [(i.start, i.pitch) for i in expected] == [(i.start, i.pitch) for i in actual], 'expand_tempos differs'
+    report('expand_tempos ({} changes, {} beats)'.format(n_changes, len(actual)),
+           timeit(lambda _: reference_expand_tempos(tempo_items), repeat=1),
+           timeit(lambda _: utils.expand_tempos(times, tempos)))
+
+
+#############################################################################################
+# TOKENIZE
+#############################################################################################
+# every event item2event can produce, numbered in a fixed order
+def full_event2word():
+    events = ['Bar_None']
+    events += ['Position_{}/{}'.format(i + 1, utils.DEFAULT_FRACTION) for i in range(utils.DEFAULT_FRACTION)]
+    events += ['Note Velocity_{}'.format(i) for i in range(len(utils.DEFAULT_VELOCITY_BINS))]
+    events += ['Note On_{}'.format(i) for i in range(128)]
+    events += ['Note Duration_{}'.format(i) for i in range(len(utils.DEFAULT_DURATION_BINS))]
+    events += ['Chord_{}'.format(chord) for chord in ['C:maj', 'A:min', 'G:dom', 'N:N']]
+    events += ['Tempo Class_{}'.format(c) for c in ['slow', 'mid', 'fast']]
+    events += ['Tempo Value_{}'.format(i) for i in range(60)]
+    return {event: word for word, event in enumerate(events)}
+
+
+def reference_item2word(groups, event2word):
+    return [event2word['{}_{}'.format(e.name, e.value)] for e in utils.item2event(groups)]
+
+
+def benchmark_tokenize(n_notes=20_000, seed=2022):
+    rng = np.random.default_rng(seed)
+    items = utils.quantize_items(random_note_items(n_notes))
+    max_time = items[-1].end
+    ticks_per_bar = utils.DEFAULT_RESOLUTION * 4
+    downbeats = np.arange(0, max_time, ticks_per_bar)
+    items += [utils.Item(name='Chord', start=int(db), end=int(db) + ticks_per_bar, velocity=None,
+                         pitch=str(rng.choice(['C:maj', 'A:min', 'G:dom', 'N:N']))) for db in downbeats]
+    # tempos cover every class, including 210 which repeats the previous tempo
+    tempos = np.concatenate([[120], rng.integers(20, 240, len(downbeats[::8]) - 1)])
+    items += [utils.Item(name='Tempo', start=int(db), end=None, velocity=None, pitch=int(tempo))
+              for db, tempo in zip(downbeats[::8], tempos)]
+    groups = utils.group_items(items, max_time)
+    event2word = full_event2word()
+    word_table = utils.WordTable(event2word)
+    expected = reference_item2word(groups, event2word)
+    actual = utils.item2word(groups, word_table)
+    assert expected == actual.tolist(), 'item2word differs'
+    report('item2word ({} notes, {} tokens)'.format(n_notes, len(actual)),
+           timeit(lambda _: reference_item2word(groups, event2word), repeat=1),
+           timeit(lambda _: utils.item2word(groups, word_table)))
+
+
+def benchmark_stream(n_notes=20_000, seed=2022):
+    rng = np.random.default_rng(seed)
+    notes = np.array([[item.start, item.end, item.velocity, item.pitch] for item in random_note_items(n_notes)],
+                     dtype=np.int64)
+    notes = notes[np.lexsort((notes[:, 3], notes[:, 0]))]
+    tempo_times = np.arange(0, notes[-1, 0], utils.DEFAULT_RESOLUTION * 8)
+    tempos = np.concatenate([[120], rng.integers(20, 240, len(tempo_times) - 1)])
+    # every chord extract_chords can name
+    event2word = full_event2word()
+    for root in utils.MIDIChord().PITCH_CLASSES:
+        for quality in ['maj', 'min', 'dim', 'aug', 'dom']:
+            event2word.setdefault('Chord_{}:{}'.format(root, quality), len(event2word))
+    word_table = utils.WordTable(event2word)
+
+    def note_items():
+        return [utils.Item(name='Note', start=int(start), end=int(end), velocity=int(velocity), pitch=int(pitch))
+                for start, end, velocity, pitch in notes.tolist()]
+
+    # the steps of NotezartTransformer.extract_groups, then item2word
+    def tokenize_items(items):
+        items = utils.quantize_items(items)
+        chord_items = utils.extract_chords(items)
+        groups = utils.group_items(chord_items + utils.expand_tempos(tempo_times, tempos) + items, items[-1].end)
+        return utils.item2word(groups, word_table)
+
+    def tokenize_stream(_):
+        blocks = (notes[start:start + 4096] for start in range(0, len(notes), 4096))
+        return np.concatenate(list(utils.iter_bar_words(blocks, tempo_times, tempos, word_table)))
+
+    expected = tokenize_items(note_items())
+    actual = tokenize_stream(None)
+    assert expected.tolist() == actual.tolist(), 'iter_bar_words differs'
+    report('iter_bar_words ({} notes, {} tokens)'.format(n_notes, len(actual)),
+           timeit(tokenize_items, note_items), timeit(tokenize_stream))
+
+
+#############################################################################################
+# DECODE
+#############################################################################################
+# the token parsing of the original write_midi, without writing the file
+def reference_decode_words(words, word2event):
+    events = utils.word_to_event(words, word2event)
+    temp_notes, temp_chords, temp_tempos = [], [], []
+    for i in range(len(events) - 3):
+        if events[i].name == 'Bar' and i > 0:
+            temp_notes.append('Bar')
+            temp_chords.append('Bar')
+            temp_tempos.append('Bar')
+        elif events[i].name == 'Position' and events[i + 1].name == 'Note Velocity' and \
+                events[i + 2].name == 'Note On' and events[i + 3].name == 'Note Duration':
+            position = int(events[i].value.split('/')[0]) - 1
+            velocity = int(utils.DEFAULT_VELOCITY_BINS[int(events[i + 1].value)])
+            pitch = int(events[i + 2].value)
+            duration = utils.DEFAULT_DURATION_BINS[int(events[i + 3].value)]
+            temp_notes.append([position, velocity, pitch, duration])
+        elif events[i].name == 'Position' and events[i + 1].name == 'Chord':
+            position = int(events[i].value.split('/')[0]) - 1
+            temp_chords.append([position, events[i + 1].value])
+        elif events[i].name == 'Position' and events[i + 1].name == 'Tempo Class' and \
+                events[i + 2].name == 'Tempo Value':
+            position = int(events[i].value.split('/')[0]) - 1
+            start = {'slow': 0, 'mid': 1, 'fast': 2}[events[i + 1].value]
+            tempo = utils.DEFAULT_TEMPO_INTERVALS[start].start + int(events[i + 2].value)
+            temp_tempos.append([position, tempo])
+
+    def ticks(temp):
+        ticks_per_bar = utils.DEFAULT_RESOLUTION * 4
+        current_bar = 0
+        for entry in temp:
+            if entry == 'Bar':
+                current_bar += 1
+            else:
+                flags = np.linspace(current_bar * ticks_per_bar, (current_bar + 1) * ticks_per_bar, utils.DEFAULT_FRACTION,
+                                    endpoint=False, dtype=int)
+                yield int(flags[entry[0]]), entry[1:]
+
+    notes = [[st, st + int(duration), velocity, pitch] for st, (velocity, pitch, duration) in ticks(temp_notes)]
+    chords = [(st, value) for st, (value,) in ticks(temp_chords)]
+    tempos = [[st, value] for st, (value,) in ticks(temp_tempos)]
+    return notes, chords, tempos
+
+
+def benchmark_decode(n_notes=20_000, seed=2022):
+    rng = np.random.default_rng(seed)
+    event2word = full_event2word()
+    word2event = {word: event for event, word in event2word.items()}
+    # generated samples are not always well formed, so mix random words into real ones
+    items = utils.quantize_items(random_note_items(n_notes))
+    words = np.array(reference_item2word(utils.group_items(items, items[-1].end), event2word))
+    noise = rng.random(len(words)) < 0.05
+    words[noise] = rng.integers(0, len(event2word), noise.sum())
+    table = utils.DecodeTable(word2event)
+    expected = reference_decode_words(words.tolist(), word2event)
+    notes, chords, tempos = utils.decode_words(words, table)
+    assert expected == (notes.tolist(), chords, tempos.tolist()), 'decode_words differs'
+    report('decode_words ({} words, {} notes)'.format(len(words), len(notes)),
+           timeit(lambda _: reference_decode_words(words.tolist(), word2event), repeat=1),
+           timeit(lambda _: utils.decode_words(words, table)))
+
+
+#############################################################################################
+# EVENT
+#############################################################################################
+class ReferenceEvent(object):
+    def __init__(self, name, time, value, text):
+        self.name = name
+        self.time = time
+        self.value = value
+        self.text = text
+
+    def __repr__(self):
+        return 'Event(name={}, time={}, value={}, text={})'.format(
+            self.name, self.time, self.value, self.text)
+
+    def __eq__(self, other):
+        return self.__repr__() == other.__repr__()
+
+    def __hash__(self):
+        return hash(self.__repr__())
+
+
+# count every distinct event of a corpus, the way a vocabulary is built
+def event_dictionary(events):
+    counts = {}
+    for event in events:
+        counts[event] = counts.get(event, 0) + 1
+    return counts
+
+
+def benchmark_event_dictionary(n_notes=20_000):
+    items = utils.quantize_items(random_note_items(n_notes))
+    events = utils.item2event(utils.group_items(items, items[-1].end))
+    reference_events = [ReferenceEvent(e.name, e.time, e.value, e.text) for e in events]
+    expected = event_dictionary(reference_events)
+    actual = event_dictionary(events)
+    assert sorted(map(repr, expected.items())) == sorted(map(repr, actual.items())), 'event dictionary differs'
+    report('event dictionary ({} events, {} distinct)'.format(len(events), len(actual)),
+           timeit(lambda _: event_dictionary(reference_events), repeat=1),
+           timeit(lambda _: event_dictionary(events)))
+
+
+#############################################################################################
+# CHORD
+#############################################################################################
+# the original extract and find_chord, which score windows of a dense tick-level pianoroll
+class ReferenceMIDIChord(utils.MIDIChord):
+    def find_chord(self, pianoroll):
+        chroma = np.sum(pianoroll, axis=0)
+        chroma = np.array([1 if c else 0 for c in np.bincount(np.arange(128) % 12, weights=chroma, minlength=12)])
+        if np.sum(chroma) == 0:
+            return 'N', 'N', 'N', 0
+        candidates = self.sequencing(chroma=chroma)
+        scores, qualities = self.scoring(candidates=candidates)
+        sorted_notes = [int(i % 12) for i, v in enumerate(np.sum(pianoroll, axis=0)) if v > 0]
+        bass_note = sorted_notes[0]
+        _max = max(scores.values())
+        best = [root_note for root_note, score in scores.items() if score == _max]
+        root_note = best[0] if len(best) == 1 else next(n for n in sorted_notes if n in best)
+        return self.PITCH_CLASSES[root_note], qualities[root_note], self.PITCH_CLASSES[bass_note], scores[root_note]
+
+    def extract(self, notes):
+        max_tick = max([n.end for n in notes])
+        ticks_per_beat = 480
+        pianoroll = self.note2pianoroll(notes=notes, max_tick=max_tick, ticks_per_beat=ticks_per_beat)
+        candidates = {}
+        for interval in [4, 2]:
+            for start_tick in range(0, max_tick, ticks_per_beat):
+                end_tick = min(int(ticks_per_beat * interval + start_tick), max_tick)
+                chord = self.find_chord(pianoroll=pianoroll[start_tick:end_tick, :])
+                candidates.setdefault(start_tick, {}).setdefault(end_tick, chord)
+        return self.greedy(candidates=candidates, max_tick=max_tick, min_length=ticks_per_beat)
+
+
+def benchmark_chords(n_notes=2_000):
+    notes = utils.quantize_items(random_note_items(n_notes))
+    expected = ReferenceMIDIChord().extract(notes)
+    actual = utils.MIDIChord().extract(notes)
+    assert expected == actual, 'MIDIChord.extract differs'
+    report('MIDIChord.extract ({} notes, {} chords)'.format(n_notes, len(actual)),
+           timeit(lambda _: ReferenceMIDIChord().extract(notes), repeat=1),
+           timeit(lambda _: utils.MIDIChord().extract(notes)))
+
+
+def benchmark_find_chords(n_windows=5_000, seed=2022):
+    rng = np.random.default_rng(seed)
+    # a few sounding pitches per window, like a beat of music
+    active = np.zeros((n_windows, 128), dtype=bool)
+    rows = np.repeat(np.arange(n_windows), 6)
+    active[rows, rng.integers(36, 96, len(rows))] = True
+    active[::10] = False
+    reference = ReferenceMIDIChord()
+    method = utils.MIDIChord()
+    method.chord_table()
+    expected = [reference.find_chord(pianoroll=window[None, :]) for window in active]
+    actual = method.find_chords(active=active)
+    assert expected == actual, 'MIDIChord.find_chords differs'
+    report('MIDIChord.find_chords ({} windows)'.format(n_windows),
+           timeit(lambda _: [reference.find_chord(pianoroll=window[None, :]) for window in active], repeat=1),
+           timeit(lambda _: method.find_chords(active=active)))
+
+
+if __name__ == '__main__':
+    benchmark_quantize()
+    benchmark_group()
+    benchmark_tempos()
+    benchmark_tokenize()
+    benchmark_stream()
+    benchmark_decode()
+    benchmark_event_dictionary()
+    benchmark_chords()
+    benchmark_find_chords()
@@ -38,7 +38,10 @@ def normal_softmax(hidden, target, n_token, params, scope='normal_softmax', **kw
     with tf.compat.v1.variable_scope(scope):
         softmax_b = tf.compat.v1.get_variable('bias', [n_token], initializer=tf.zeros_initializer())
         output = _logit(hidden, params_W, softmax_b, params_projs)
-        nll = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=target, logits=output)
+        # no target: inference, only the logits are needed
+        nll = None
+        if target is not None:
+            nll = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=target, logits=output)
     return nll, output
 
 
@@ -96,24 +99,56 @@ def rel_shift(x):
     return x
 
 
+# collection of the ops that fill the cached r projections, run them once after restoring the weights
+KV_CACHE_INIT = 'kv_cache_init'
+
+
 def rel_multihead_attn(w, r, r_w_bias, r_r_bias, attn_mask, mems, d_model,
                        n_head, d_head, dropout, dropatt, is_training,
-                       kernel_initializer, scope='rel_attn'):
+                       kernel_initializer, scope='rel_attn', kv_mem=None, cache_r=None, mem_len=None):
+    """
+    kv_mem: projected keys and values of the memory, [mlen, bsz, 2 * n_head * d_head].
+        When given, only w goes through the qkv projection and (output, new_kv_mem) is returned.
+    cache_r: positional embedding of the mem_len + 1 positions of an incremental step.
+        Its projection is kept in a local variable (filled by the KV_CACHE_INIT ops) and used whenever r has
+        that length.
+    """
     scale = 1 / (d_head ** 0.5)
     with tf.compat.v1.variable_scope(scope):
         qlen = tf.shape(w)[0]
         rlen = tf.shape(r)[0]
         bsz = tf.shape(w)[1]
 
-        cat = tf.concat([mems, w], 0) if mems is not None and mems.shape.ndims > 1 else w
+        qkv = tf.keras.layers.Dense(3 * n_head * d_head, use_bias=False,
+                                    kernel_initializer=kernel_initializer, name='qkv')
+        r_proj = tf.keras.layers.Dense(n_head * d_head, use_bias=False,
+                                       kernel_initializer=kernel_initializer, name='r')
 
-        w_heads = tf.keras.layers.Dense(3 * n_head * d_head, use_bias=False, 
-                                        kernel_initializer=kernel_initializer, name='qkv')(cat)
-        r_head_k = tf.keras.layers.Dense(n_head * d_head, use_bias=False,
-                                         kernel_initializer=kernel_initializer, name='r')(r)
-        
-        w_head_q, w_head_k, w_head_v = tf.split(w_heads, 3, -1)
-        w_head_q = w_head_q[-qlen:]
+        if kv_mem is None:
+            cat = tf.concat([mems, w], 0) if mems is not None and mems.shape.ndims > 1 else w
+
+            w_heads = qkv(cat)
+            r_head_k = r_proj(r)
+
+            w_head_q, w_head_k, w_head_v = tf.split(w_heads, 3, -1)
+            w_head_q = w_head_q[-qlen:]
+        else:
+            # the projection is row-wise, so the memory rows were projected when they were new
+            w_head_q, new_head_k, new_head_v = tf.split(qkv(w), 3, -1)
+            new_kv = tf.concat([new_head_k, new_head_v], -1)
+            new_kv_mem = tf.stop_gradient(tf.concat([kv_mem, new_kv], 0)[-mem_len:])
+            mem_head_k, mem_head_v = tf.split(kv_mem, 2, -1)
+            w_head_k = tf.concat([mem_head_k, new_head_k], 0)
+            w_head_v = tf.concat([mem_head_v, new_head_v], 0)
+            if cache_r is None:
+                r_head_k = r_proj(r)
+            else:
+                r_cache = tf.compat.v1.get_variable(
+                    'r_cache', [cache_r.shape[0], 1, n_head * d_head], initializer=tf.zeros_initializer(),
+                    trainable=False, collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES])
+                tf.compat.v1.add_to_collection(KV_CACHE_INIT, r_cache.assign(r_proj(cache_r)))
+                r_head_k = tf.cond(tf.equal(rlen, tf.shape(r_cache)[0]),
+                                   lambda: tf.identity(r_cache), lambda: r_proj(r))
 
         klen = tf.shape(w_head_k)[0]
 
@@ -145,6 +180,8 @@ def rel_multihead_attn(w, r, r_w_bias, r_r_bias, attn_mask, mems, d_model,
                                          kernel_initializer=kernel_initializer, name='o')(attn_vec)
         attn_out = tf.keras.layers.Dropout(dropout)(attn_out, training=is_training)
         output = tf.keras.layers.LayerNormalization(axis=-1)(attn_out + w)
+        if kv_mem is not None:
+            return output, new_kv_mem
         return output
 
 
@@ -155,12 +192,14 @@ def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
                 same_length=False, clamp_len=-1,
                 input_perms=None, target_perms=None, head_target=None,
                 untie_r=False, proj_same_dim=True,
-                scope='transformer'):
+                scope='transformer', kv_cache=False):
     """
     cutoffs: a list of python int. Cutoffs for adaptive softmax.
     tie_projs: a list of python bools. Whether to tie the projections.
     perms: a list of tensors. Each tensor should of size [len, bsz, bin_size].
         Only used in the adaptive setting.
+    kv_cache: inference mode for incremental decoding. mems are then the projected keys and values of every
+        layer, [mem_len, bsz, 2 * n_head * d_head], and so are the returned new mems.
     """
     new_mems = []
     with tf.compat.v1.variable_scope(scope):
@@ -197,12 +236,21 @@ def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
         output = tf.keras.layers.Dropout(rate=dropout)(embeddings, training=is_training)
         pos_emb = tf.keras.layers.Dropout(rate=dropout)(pos_emb, training=is_training)
 
+        # positions of an incremental step (one new token after mem_len memories), projected once per layer
+        cache_pos_emb = None
+        if kv_cache:
+            cache_pos_seq = tf.range(mem_len, -1, -1.0)
+            if clamp_len > 0:
+                cache_pos_seq = tf.minimum(cache_pos_seq, clamp_len)
+            cache_pos_emb = positional_embedding(cache_pos_seq, inv_freq)
+
         if mems is None:
             mems = [None] * n_layer
 
         for i in range(n_layer):
             # cache new mems
-            new_mems.append(_cache_mem(output, mems[i], mem_len))
+            if not kv_cache:
+                new_mems.append(_cache_mem(output, mems[i], mem_len))
 
             with tf.compat.v1.variable_scope('layer_{}'.format(i)):
                 output = rel_multihead_attn(
@@ -218,7 +266,13 @@ def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
                     dropout=dropout,
                     dropatt=dropatt,
                     is_training=is_training,
-                    kernel_initializer=initializer)
+                    kernel_initializer=initializer,
+                    kv_mem=mems[i] if kv_cache else None,
+                    cache_r=cache_pos_emb,
+                    mem_len=mem_len)
+                if kv_cache:
+                    output, new_kv_mem = output
+                    new_mems.append(new_kv_mem)
 
                 output = positionwise_FF(
                     inp=output,
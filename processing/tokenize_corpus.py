@@ -0,0 +1,167 @@
+# Tokenize a DATASET_INFO dataset for NotezartTransformer
+# Every file is tokenized once into an int16 array of vocabulary ids and cached by content (see data.feature_cache),
+# so a rerun only tokenizes the files that changed. The tokens do not depend on a model dictionary:
+# to_words maps them to the words of any dictionary, and build_dictionary creates one from the corpus.
+# Run with: python -m processing.tokenize_corpus ADL --workers 8 --dictionary <checkpoint>/dictionary/dictionary_ADL.pkl
+
+import argparse
+import json
+import os
+import pickle
+from functools import partial
+
+import numpy as np
+
+import processing.utils as utils
+from data.feature_cache import FeatureCache, lookup, write_json
+from data.load_data import CACHE_PATH, get_all_files
+from data.parallel import imap_ordered
+from data.quarantine import Quarantine
+
+# bump whenever the tokens of a file change
+TOKENIZER_VERSION = 1
+TOKENS_PATH = f'{CACHE_PATH}/tokens'
+# files the tokenizer failed on, kept apart from the feature pipeline's quarantine since many failures
+# (no tempo change at tick 0, no first instrument, ...) only affect this tokenizer
+QUARANTINE_PATH = f'{TOKENS_PATH}/quarantine.json'
+
+
+# every event item2event can produce, sorted like the keys of a dictionary built with np.unique
+def build_vocabulary():
+    events = ['Bar_None']
+    events += ['Position_{}/{}'.format(i + 1, utils.DEFAULT_FRACTION) for i in range(utils.DEFAULT_FRACTION)]
+    events += ['Note Velocity_{}'.format(i) for i in range(len(utils.DEFAULT_VELOCITY_BINS))]
+    events += ['Note On_{}'.format(i) for i in range(128)]
+    events += ['Note Duration_{}'.format(i) for i in range(len(utils.DEFAULT_DURATION_BINS))]
+    events += ['Chord_{}:{}'.format(root, quality) for root in utils.MIDIChord().PITCH_CLASSES
+               for quality in ['maj', 'min', 'dim', 'aug', 'dom']]
+    events += ['Chord_N:N']
+    events += ['Tempo Class_{}'.format(c) for c in ['slow', 'mid', 'fast']]
+    events += ['Tempo Value_{}'.format(i) for i in range(len(utils.DEFAULT_TEMPO_INTERVALS[0]))]
+    return sorted(events)
+
+
+VOCABULARY = build_vocabulary()
+VOCABULARY_TABLE = utils.WordTable({event: token for token, event in enumerate(VOCABULARY)})
+
+
+# same pipeline as NotezartTransformer.extract_groups, returns (tokens, None) or (None, reason it failed)
+def tokenize_file(path, chords=True):
+    try:
+        note_items, tempo_items = utils.read_items(path, lazy_tempo=True)
+        note_items = utils.quantize_items(note_items)
+        max_time = note_items[-1].end
+        if chords:
+            chord_items = utils.extract_chords(note_items)
+            items = chord_items + tempo_items + note_items
+        else:
+            items = tempo_items + note_items
+        groups = utils.group_items(items, max_time)
+        return utils.item2word(groups, VOCABULARY_TABLE).astype(np.int16), None
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+
+# look a (path, index record) item up in the token cache and only tokenize the file on a miss
+# runs in the workers, so files are hashed as they are reached instead of all up front
+def tokenize_cached(item, root, version, chords=True):
+    path, record = item
+    entry, record = lookup(path, record, root, version)
+    if entry is not None:
+        return entry, record, None, None
+    tokens, reason = tokenize_file(path, chords=chords)
+    return None, record, tokens, reason
+
+
+def manifest_path(dataset_name, chords=True):
+    return '{}/{}_{}.json'.format(TOKENS_PATH, dataset_name, 'chord' if chords else 'plain')
+
+
+# tokenize every file of a dataset, reusing the cached tokens of files that did not change
+# writes a manifest listing the token file of every tokenized source file, in dataset order
+def tokenize_corpus(dataset_name='ADL', chords=True, num_workers=1):
+    quarantine = Quarantine(QUARANTINE_PATH)
+    paths = quarantine.filter(get_all_files(dataset_name=dataset_name, skip_quarantined=False))
+    cache = FeatureCache('{}/{}'.format(TOKENS_PATH, 'chord' if chords else 'plain'), TOKENIZER_VERSION)
+    items = [(path, cache.index.get(path)) for path in paths]
+
+    files = []
+    hits = misses = 0
+    tokenized = imap_ordered(partial(tokenize_cached, root=cache.root, version=cache.version, chords=chords),
+                             items, num_workers=num_workers)
+    try:
+        for (entry, record, tokens, reason), path in zip(tokenized, paths):
+            if entry is None:
+                misses += 1
+                if tokens is None:
+                    quarantine.add(path, reason)
+                    continue
+                entry = cache.store(path, tokens, content_hash=record['hash'])
+                n_tokens = len(tokens)
+            else:
+                hits += 1
+                cache.update(path, record)
+                n_tokens = len(np.load(entry, mmap_mode='r'))
+            files.append([path, os.path.basename(entry), n_tokens])
+    finally:
+        print('Token cache: {} hits, {} misses, {} quarantined'.format(hits, misses, len(quarantine)))
+        quarantine.save()
+        cache.save()
+
+    manifest = {'version': TOKENIZER_VERSION, 'chords': chords, 'root': cache.root,
+                'vocabulary': VOCABULARY, 'files': files}
+    write_json(manifest_path(dataset_name, chords), manifest)
+    print('Tokenized {} files, {} tokens'.format(len(files), sum(n for _, _, n in files)))
+    return manifest
+
+
+# token arrays of a tokenized dataset, in manifest order
+def load_tokens(dataset_name='ADL', chords=True, mmap_mode=None):
+    with open(manifest_path(dataset_name, chords), 'r') as f:
+        manifest = json.load(f)
+    if manifest['vocabulary'] != VOCABULARY:
+        raise ValueError('{} was tokenized with another vocabulary, run tokenize_corpus again'.format(dataset_name))
+    return [np.load('{}/{}'.format(manifest['root'], entry), mmap_mode=mmap_mode)
+            for _, entry, _ in manifest['files']]
+
+
+# dictionary over the events present in the corpus, numbered like the Gen4B build_lookup (sorted event keys)
+def build_dictionary(all_tokens):
+    present = np.unique(np.concatenate([np.unique(tokens) for tokens in all_tokens]))
+    event2word = {VOCABULARY[token]: word for word, token in enumerate(present.tolist())}
+    word2event = {word: event for event, word in event2word.items()}
+    return event2word, word2event
+
+
+# tokens to the words of a model dictionary, with the OOV rules of NotezartTransformer.prepare_data
+def to_words(all_tokens, event2word):
+    remap = np.array([event2word.get(event, -1) for event in VOCABULARY], dtype=np.int64)
+    # OOV velocity is replaced with max velocity based on our training data
+    velocities = np.array([event.startswith('Note Velocity_') for event in VOCABULARY])
+    remap[velocities & (remap < 0)] = event2word['Note Velocity_21']
+    all_words = []
+    for tokens in all_tokens:
+        words = remap[tokens]
+        if (words < 0).any():
+            # something is wrong, you should handle it for your own purpose
+            print('something is wrong! {}'.format(sorted({VOCABULARY[t] for t in tokens[words < 0].tolist()})))
+            words = words[words >= 0]
+        all_words.append(words)
+    return all_words
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tokenize a dataset for NotezartTransformer')
+    parser.add_argument('dataset_name', nargs='?', default='ADL', help='dataset name, a key of DATASET_INFO')
+    parser.add_argument('--plain', action='store_true', help='no chord events, for models without chords')
+    parser.add_argument('--workers', type=int, default=0, help='tokenizing processes, 0 uses all cores')
+    parser.add_argument('--dictionary', help='write a dictionary of the tokenized corpus to this path')
+    args = parser.parse_args()
+
+    tokenize_corpus(dataset_name=args.dataset_name, chords=not args.plain, num_workers=args.workers)
+    if args.dictionary:
+        event2word, word2event = build_dictionary(load_tokens(args.dataset_name, chords=not args.plain))
+        os.makedirs(os.path.dirname(args.dictionary) or '.', exist_ok=True)
+        with open(args.dictionary, 'wb') as handle:
+            pickle.dump([event2word, word2event], handle, protocol=pickle.HIGHEST_PROTOCOL)
+        print('Dictionary of {} events written to {}'.format(len(event2word), args.dictionary))
@@ -32,7 +32,8 @@ class Item(object):
 
 
 # read notes and tempo changes from midi (assume there is only one track)
-def read_items(file_path):
+# lazy_tempo returns the beat-level tempos as TempoItems instead of a list of Item
+def read_items(file_path, lazy_tempo=False):
     midi_obj = miditoolkit.midi.parser.MidiFile(file_path)
     # note
     note_items = []
@@ -57,39 +58,87 @@ def read_items(file_path):
             pitch=int(tempo.tempo)))
     tempo_items.sort(key=lambda x: x.start)
     # expand to all beat
-    max_tick = tempo_items[-1].start
-    existing_ticks = {item.start: item.pitch for item in tempo_items}
-    wanted_ticks = np.arange(0, max_tick + 1, DEFAULT_RESOLUTION)
-    output = []
-    for tick in wanted_ticks:
-        if tick in existing_ticks:
-            output.append(Item(
-                name='Tempo',
-                start=tick,
-                end=None,
-                velocity=None,
-                pitch=existing_ticks[tick]))
-        else:
-            output.append(Item(
-                name='Tempo',
-                start=tick,
-                end=None,
-                velocity=None,
-                pitch=output[-1].pitch))
-    tempo_items = output
+    tempo_items = expand_tempos(
+        times=[item.start for item in tempo_items],
+        tempos=[item.pitch for item in tempo_items])
+    if not lazy_tempo:
+        tempo_items = list(tempo_items)
     return note_items, tempo_items
 
 
+# tempo of every beat up to the last tempo change: a beat takes the last tempo change exactly on it,
+# or keeps the tempo of the previous beat (tempo changes between beats are ignored)
+def expand_tempos(times, tempos):
+    times = np.asarray(times, dtype=np.int64)
+    tempos = np.asarray(tempos, dtype=np.int64)
+    max_tick = times[-1]
+    on_beat = times % DEFAULT_RESOLUTION == 0
+    times, tempos = times[on_beat], tempos[on_beat]
+    wanted_ticks = np.arange(0, max_tick + 1, DEFAULT_RESOLUTION)
+    # the last change at or before each beat, so equal times keep the last one
+    index = np.searchsorted(times, wanted_ticks, side='right') - 1
+    if index[0] < 0:
+        raise ValueError('no tempo change at tick 0')
+    return TempoItems(wanted_ticks, tempos[index])
+
+
+# beat-level tempo items stored as arrays, Items are only created when they are accessed
+class TempoItems(object):
+    def __init__(self, starts, tempos):
+        self.starts = starts
+        self.tempos = tempos
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return TempoItems(self.starts[index], self.tempos[index])
+        return Item(name='Tempo', start=int(self.starts[index]), end=None, velocity=None,
+                    pitch=int(self.tempos[index]))
+
+    def __iter__(self):
+        for start, tempo in zip(self.starts.tolist(), self.tempos.tolist()):
+            yield Item(name='Tempo', start=start, end=None, velocity=None, pitch=tempo)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return 'TempoItems(n={})'.format(len(self))
+
+
+# index of the nearest grid point for every value, ties go to the lower index like np.argmin(abs(grid - value))
+def nearest_index(grid, values):
+    values = np.asarray(values)
+    if len(grid) == 1:
+        return np.zeros(values.shape, dtype=np.int64)
+    index = np.clip(np.searchsorted(grid, values, side='left'), 1, len(grid) - 1)
+    lower = grid[index - 1]
+    upper = grid[index]
+    return index - ((values - lower) <= (upper - values))
+
+
+# quantize note starts (and shift ends along) in one vectorized pass
+def quantize_times(starts, ends, grid_end, ticks=120):
+    grids = np.arange(0, grid_end, ticks, dtype=int)
+    if len(grids) == 0:
+        raise ValueError('cannot quantize items that all start at tick 0')
+    shifts = grids[nearest_index(grids, starts)] - starts
+    return starts + shifts, ends + shifts
+
+
 # quantize items
 def quantize_items(items, ticks=120):
-    # grid
-    grids = np.arange(0, items[-1].start, ticks, dtype=int)
-    # process
-    for item in items:
-        index = np.argmin(abs(grids - item.start))
-        shift = grids[index] - item.start
-        item.start += shift
-        item.end += shift
+    starts = np.array([item.start for item in items], dtype=np.int64)
+    ends = np.array([item.end for item in items], dtype=np.int64)
+    starts, ends = quantize_times(starts, ends, items[-1].start, ticks)
+    for item, start, end in zip(items, starts.tolist(), ends.tolist()):
+        item.start = start
+        item.end = end
     return items
 
 
@@ -112,40 +161,62 @@ def extract_chords(items):
 def group_items(items, max_time, ticks_per_bar=DEFAULT_RESOLUTION * 4):
     items.sort(key=lambda x: x.start)
     downbeats = np.arange(0, max_time + ticks_per_bar, ticks_per_bar)
+    # items are sorted, so the insiders of [db1, db2) are one contiguous slice
+    starts = np.array([item.start for item in items], dtype=np.int64)
+    bounds = np.searchsorted(starts, downbeats, side='left')
     groups = []
-    for db1, db2 in zip(downbeats[:-1], downbeats[1:]):
-        insiders = []
-        for item in items:
-            if (item.start >= db1) and (item.start < db2):
-                insiders.append(item)
-        overall = [db1] + insiders + [db2]
+    for db1, db2, first, last in zip(downbeats[:-1], downbeats[1:], bounds[:-1], bounds[1:]):
+        overall = [db1] + items[first:last] + [db2]
         groups.append(overall)
     return groups
 
 
 # define "Event" for event storage
+# events are immutable values: they hash and compare on their fields, never on their repr
 class Event(object):
+    __slots__ = ('_fields', '_key')
+
     def __init__(self, name, time, value, text):
-        self.name = name
-        self.time = time
-        self.value = value
-        self.text = text
+        self._fields = (name, time, value, text)
+        self._key = None
+
+    name = property(lambda self: self._fields[0])
+    time = property(lambda self: self._fields[1])
+    value = property(lambda self: self._fields[2])
+    text = property(lambda self: self._fields[3])
 
     def __repr__(self):
-        return 'Event(name={}, time={}, value={}, text={})'.format(
-            self.name, self.time, self.value, self.text)
+        return 'Event(name={}, time={}, value={}, text={})'.format(*self._fields)
 
     def __eq__(self, other):
-        return self.__repr__() == other.__repr__()
+        if not isinstance(other, Event):
+            return NotImplemented
+        return self._fields == other._fields
+
+    def __ne__(self, other):
+        if not isinstance(other, Event):
+            return NotImplemented
+        return self._fields != other._fields
 
+    # fields mix None, ints and strings, so events keep sorting in repr order
     def __lt__(self, other):
         return self.__repr__() < other.__repr__()
 
     def __hash__(self):
-        return hash(self.__repr__())
+        return hash(self._fields)
+
+    def __reduce__(self):
+        return Event, self._fields
+
+    # events pickled before Event had slots carry their fields as a __dict__
+    def __setstate__(self, state):
+        self._fields = (state['name'], state['time'], state['value'], state['text'])
+        self._key = None
 
     def to_key(self):
-        return f"{self.name}_{self.value}"
+        if self._key is None:
+            self._key = f"{self._fields[0]}_{self._fields[2]}"
+        return self._key
 
 
 # item to event
@@ -227,6 +298,348 @@ def item2event(groups):
     return events
 
 
+# precomputed "name_value" => word lookup tables, so tokens never go through strings
+class WordTable(object):
+    def __init__(self, event2word):
+        self.event2word = event2word
+        self.bar = event2word.get('Bar_None', -1)
+        self.position = self._lookup(['Position_{}/{}'.format(i + 1, DEFAULT_FRACTION) for i in range(DEFAULT_FRACTION)])
+        # OOV velocity is replaced with max velocity based on our training data
+        velocity_fallback = event2word.get('Note Velocity_21', -1)
+        self.velocity = self._lookup(['Note Velocity_{}'.format(i) for i in range(len(DEFAULT_VELOCITY_BINS))],
+                                     default=velocity_fallback)
+        self.pitch = self._lookup(['Note On_{}'.format(i) for i in range(128)])
+        self.duration = self._lookup(['Note Duration_{}'.format(i) for i in range(len(DEFAULT_DURATION_BINS))])
+        self.tempo_class = self._lookup(['Tempo Class_{}'.format(c) for c in ['slow', 'mid', 'fast']])
+        self.tempo_value = self._lookup(['Tempo Value_{}'.format(i) for i in range(len(DEFAULT_TEMPO_INTERVALS[0]))])
+
+    def _lookup(self, keys, default=-1):
+        return np.array([self.event2word.get(key, default) for key in keys], dtype=np.int64)
+
+    def chord(self, value):
+        return self.event2word.get('Chord_{}'.format(value), -1)
+
+
+# tempo class index (0 slow, 1 mid, 2 fast) and value of every tempo, same rules as item2event
+def tempo_classes(tempos):
+    tempos = np.asarray(tempos, dtype=np.int64)
+    conditions = [(tempos >= interval.start) & (tempos < interval.stop) for interval in DEFAULT_TEMPO_INTERVALS]
+    conditions += [tempos < DEFAULT_TEMPO_INTERVALS[0].start, tempos > DEFAULT_TEMPO_INTERVALS[2].stop]
+    classes = np.select(conditions, [0, 1, 2, 0, 2], default=-1)
+    values = np.select(conditions, [tempos - interval.start for interval in DEFAULT_TEMPO_INTERVALS] + [0, 59],
+                       default=-1)
+    # a tempo of exactly DEFAULT_TEMPO_INTERVALS[2].stop has no class: item2event repeats the previous tempo events
+    matched = classes >= 0
+    if not matched.all():
+        previous = np.maximum.accumulate(np.where(matched, np.arange(len(tempos)), -1))
+        if previous.min() < 0:
+            raise ValueError('tempo {} has no tempo class'.format(tempos[np.argmin(previous)]))
+        classes, values = classes[previous], values[previous]
+    return classes, values
+
+
+# kinds of items, in the order items with the same start are tokenized
+ITEM_CHORD, ITEM_TEMPO, ITEM_NOTE = range(3)
+
+
+# word ids of the items of consecutive bars, every argument is an array with one entry per item in token order
+# (bar_st and bar_et of the item's bar, notes is [start, end, velocity, pitch], only note rows are read),
+# chord_words and tempo_classes / tempo_values (see tempo_classes) only hold the chord and tempo items
+def bar_words(first_in_bar, bar_st, bar_et, kinds, notes, chord_words, classes, values, word_table):
+    starts = notes[:, 0]
+    is_note = kinds == ITEM_NOTE
+    # one row of token slots per item: [bar, position, *item tokens], PAD slots are dropped at the end
+    PAD = -2
+    tokens = np.full((len(kinds), 5), PAD, dtype=np.int64)
+    tokens[first_in_bar, 0] = word_table.bar
+    # position: nearest of the DEFAULT_FRACTION np.linspace(bar_st, bar_et) flags
+    step = (bar_et - bar_st) / DEFAULT_FRACTION
+    flags = np.arange(DEFAULT_FRACTION)[None, :] * step[:, None] + bar_st[:, None]
+    tokens[:, 1] = word_table.position[np.argmin(abs(flags - starts[:, None]), axis=1)]
+    # note: velocity, pitch, duration
+    velocity_index = np.searchsorted(DEFAULT_VELOCITY_BINS, notes[is_note, 2], side='right') - 1
+    tokens[is_note, 2] = word_table.velocity[velocity_index]
+    tokens[is_note, 3] = word_table.pitch[notes[is_note, 3]]
+    durations = notes[is_note, 1] - notes[is_note, 0]
+    tokens[is_note, 4] = word_table.duration[nearest_index(DEFAULT_DURATION_BINS, durations)]
+    # chord
+    tokens[kinds == ITEM_CHORD, 2] = chord_words
+    # tempo: class and value
+    tokens[kinds == ITEM_TEMPO, 2] = word_table.tempo_class[classes]
+    tokens[kinds == ITEM_TEMPO, 3] = word_table.tempo_value[values]
+
+    words = tokens.ravel()
+    words = words[words != PAD]
+    if (words < 0).any():
+        # something is wrong, you should handle it for your own purpose
+        print('something is wrong! {} tokens are not in the dictionary'.format(np.sum(words < 0)))
+        words = words[words >= 0]
+    return words
+
+
+# item to word: same tokens as item2event, emitted as integer word ids in one array
+def item2word(groups, word_table):
+    groups = [group for group in groups if any(item.name == 'Note' for item in group[1:-1])]
+    if len(groups) == 0:
+        return np.zeros(0, dtype=np.int64)
+    items = [item for group in groups for item in group[1:-1]]
+    group_sizes = [len(group) - 2 for group in groups]
+    bar_index = np.repeat(np.arange(len(groups)), group_sizes)
+    bar_st = np.array([group[0] for group in groups], dtype=np.int64)[bar_index]
+    bar_et = np.array([group[-1] for group in groups], dtype=np.int64)[bar_index]
+    first_in_bar = np.concatenate([[0], np.cumsum(group_sizes)[:-1]])
+    item_kinds = {'Chord': ITEM_CHORD, 'Tempo': ITEM_TEMPO, 'Note': ITEM_NOTE}
+    kinds = np.array([item_kinds[item.name] for item in items], dtype=np.int64)
+    notes = np.array([[item.start, item.end, item.velocity, item.pitch] if item.name == 'Note' else
+                      [item.start, 0, 0, 0] for item in items], dtype=np.int64)
+    chord_words = [word_table.chord(item.pitch) for item in items if item.name == 'Chord']
+    classes, values = tempo_classes([item.pitch for item in items if item.name == 'Tempo'])
+    return bar_words(first_in_bar, bar_st, bar_et, kinds, notes, chord_words, classes, values, word_table)
+
+
+# all notes of a midi file as a (n, 4) array of [start, end, velocity, pitch] sorted like read_items,
+# and the times and tempos of its tempo changes
+def read_arrays(file_path):
+    midi_obj = miditoolkit.midi.parser.MidiFile(file_path)
+    notes = np.array([[note.start, note.end, note.velocity, note.pitch]
+                      for note in midi_obj.instruments[0].notes], dtype=np.int64).reshape((-1, 4))
+    notes = notes[np.lexsort((notes[:, 3], notes[:, 0]))]
+    tempo_times = np.array([tempo.time for tempo in midi_obj.tempo_changes], dtype=np.int64)
+    tempos = np.array([int(tempo.tempo) for tempo in midi_obj.tempo_changes], dtype=np.int64)
+    return notes, tempo_times, tempos
+
+
+# incremental version of read_items + quantize_items + extract_chords + group_items + item2word: notes come in
+# block by block (in read_items order, not quantized) and the words of a bar come out as soon as nothing can change
+# them anymore. A note is quantized once a later note start bounds the grid, a chord is chosen once all the notes
+# of its longest candidate window (4 beats) are known, and a bar is tokenized once no note or chord can start in it,
+# so only the notes of the next two bars or so (and the notes still sounding over them) are held.
+# The first bar waits for the first chord of the file, since MIDIChord.greedy moves it back to tick 0.
+class BarTokenizer(object):
+    def __init__(self, tempo_times, tempos, word_table, chords=True, ticks_per_bar=DEFAULT_RESOLUTION * 4,
+                 ticks=120):
+        self.word_table = word_table
+        self.chords = chords
+        self.ticks_per_bar = ticks_per_bar
+        self.ticks = ticks
+        # tempo changes on a beat, sorted like read_items, a beat takes the last one at or before it
+        # (see expand_tempos), beats after the last tempo change have no tempo item
+        tempo_times = np.asarray(tempo_times, dtype=np.int64)
+        tempos = np.asarray(tempos, dtype=np.int64)
+        order = np.argsort(tempo_times, kind='stable')
+        tempo_times, tempos = tempo_times[order], tempos[order]
+        self.last_tempo_time = int(tempo_times[-1])
+        on_beat = tempo_times % DEFAULT_RESOLUTION == 0
+        self.tempo_times, self.tempos = tempo_times[on_beat], tempos[on_beat]
+        if len(self.tempo_times) == 0 or self.tempo_times[0] != 0:
+            raise ValueError('no tempo change at tick 0')
+        self.previous_tempo = None
+        # raw notes waiting for their grid point, then quantized notes waiting for their bar
+        self.pending = np.zeros((0, 4), dtype=np.int64)
+        self.notes = np.zeros((0, 4), dtype=np.int64)
+        self.last_start = None
+        # start and end of the last quantized note (the max_time of group_items), largest quantized end so far
+        self.frontier = -1
+        self.last_end = 0
+        self.max_end = 0
+        self.next_bar = 0
+        # greedy chord position, the notes that may still sound after it as [start, end, pitch]
+        # (see MIDIChord.beat_counts), and the chosen chords waiting for their bar
+        self.chord_tick = 0
+        self.chord_finder = MIDIChord()
+        self.sounding = np.zeros((0, 3), dtype=np.int64)
+        self.chord_starts, self.chord_words = [], []
+        self.found_chord = False
+
+    # add the next notes, returns the words of every bar they complete
+    def feed(self, notes):
+        notes = np.asarray(notes, dtype=np.int64).reshape((-1, 4))
+        if len(notes) > 0:
+            self.pending = np.concatenate([self.pending, notes])
+            self.last_start = int(notes[-1, 0])
+        return self.advance(done=False)
+
+    # no more notes, returns the words of the remaining bars
+    def close(self):
+        if self.last_start is None:
+            raise ValueError('cannot tokenize a file without notes')
+        if self.last_start == 0:
+            raise ValueError('cannot quantize items that all start at tick 0')
+        return self.advance(done=True)
+
+    def advance(self, done):
+        self.quantize(done)
+        if self.chords:
+            self.choose_chords(done)
+            if done and not self.found_chord:
+                print('NO CHORD')
+        return self.tokenize_bars(done)
+
+    # quantize_times on the grid up to the last note start: the nearest grid point (ties go to the lower one)
+    # of a start is final as soon as it is before the last start seen
+    def quantize(self, done):
+        if self.last_start is None or len(self.pending) == 0:
+            return
+        nearest = (self.pending[:, 0] + (self.ticks - 1) // 2) // self.ticks * self.ticks
+        if done:
+            n_final = len(self.pending)
+        else:
+            n_final = np.searchsorted(nearest, self.last_start, side='left')
+        if n_final == 0:
+            return
+        notes = self.pending[:n_final].copy()
+        grid_end = max(self.last_start - 1, 0) // self.ticks * self.ticks
+        shifts = np.minimum(nearest[:n_final], grid_end) - notes[:, 0]
+        notes[:, 0] += shifts
+        notes[:, 1] += shifts
+        self.pending = self.pending[n_final:]
+        self.notes = np.concatenate([self.notes, notes])
+        self.frontier, self.last_end = int(notes[-1, 0]), int(notes[-1, 1])
+        self.max_end = max(self.max_end, int(notes[:, 1].max()))
+        if self.chords:
+            # notes without velocity are dropped and zero-length notes last one tick, like in beat_counts
+            notes = notes[notes[:, 2] != 0]
+            ends = np.where(notes[:, 1] == notes[:, 0], notes[:, 0] + 1, notes[:, 1])
+            self.sounding = np.concatenate([self.sounding, np.column_stack([notes[:, 0], ends, notes[:, 3]])])
+
+    # MIDIChord.extract_arrays and greedy, as far as the candidate windows are complete
+    def choose_chords(self, done):
+        ticks_per_beat = 480
+        first_beat = self.chord_tick // ticks_per_beat
+        if done:
+            max_tick = self.max_end
+            if max_tick == 0:
+                raise ValueError('cannot extract chords from notes that all end at tick 0')
+            n_beats = -(-max_tick // ticks_per_beat)
+            # candidates from first_beat to the last beat, windows are cut by max_tick
+            last_beat = count_end = n_beats
+            stop_tick = max_tick
+        else:
+            # a window is complete once a quantized note starts after it, max_tick is then past it as well
+            last_beat = self.frontier // ticks_per_beat - 3
+            count_end = last_beat + 3
+            stop_tick = last_beat * ticks_per_beat
+        if last_beat <= first_beat or self.chord_tick >= stop_tick:
+            return
+
+        # number of notes sounding in every beat from first_beat to count_end, per pitch
+        starts, ends, pitches = self.sounding[:, 0], self.sounding[:, 1], self.sounding[:, 2]
+        if done:
+            ends = np.minimum(ends, max_tick)
+        first = np.maximum(starts // ticks_per_beat, first_beat)
+        last = np.minimum((ends - 1) // ticks_per_beat + 1, count_end)
+        keep = (ends > starts) & (first < last)
+        diff = np.zeros((count_end - first_beat + 1, 128), dtype=np.int64)
+        np.add.at(diff, (first[keep] - first_beat, pitches[keep]), 1)
+        np.add.at(diff, (last[keep] - first_beat, pitches[keep]), -1)
+        prefix = np.zeros((len(diff), 128), dtype=np.int64)
+        np.cumsum(np.cumsum(diff[:-1], axis=0), axis=0, out=prefix[1:])
+        beats = np.arange(last_beat - first_beat)
+        candidates = {}
+        for interval in [4, 2]:
+            active = prefix[np.minimum(beats + interval, len(diff) - 1)] - prefix[beats] > 0
+            candidates[interval] = self.chord_finder.find_chords(active=active)
+
+        while self.chord_tick < stop_tick:
+            beat = self.chord_tick // ticks_per_beat - first_beat
+            _candidates = {}
+            for interval in [4, 2]:
+                end_tick = self.chord_tick + ticks_per_beat * interval
+                if done and end_tick > max_tick:
+                    end_tick = max_tick
+                if end_tick not in _candidates:
+                    _candidates[end_tick] = candidates[interval][beat]
+            end_tick, (root_note, quality, _, _) = sorted(_candidates.items(), key=lambda x: (x[1][-1], x[0]))[-1]
+            # chords without quality are dropped, the first chord with one starts at tick 0 instead
+            if quality != 'None':
+                start = self.chord_tick if self.found_chord else 0
+                self.found_chord = True
+                if start >= self.next_bar * self.ticks_per_bar:
+                    self.chord_starts.append(start)
+                    self.chord_words.append(self.word_table.chord('{}:{}'.format(root_note, quality)))
+            self.chord_tick = end_tick
+        # notes that ended before the current beat can't sound in a later window
+        beat = self.chord_tick // ticks_per_beat
+        self.sounding = self.sounding[(self.sounding[:, 1] - 1) // ticks_per_beat >= beat]
+
+    # words of the bars nothing can be added to anymore, one array per bar with notes
+    def tokenize_bars(self, done):
+        if done:
+            # the bars of group_items end at the last note end
+            ready = -(-self.last_end // self.ticks_per_bar)
+        else:
+            ready = self.frontier // self.ticks_per_bar
+            if self.chords:
+                ready = min(ready, self.chord_tick // self.ticks_per_bar)
+                if not self.found_chord and self.next_bar == 0 and \
+                        len(self.notes) > 0 and self.notes[0, 0] < self.ticks_per_bar:
+                    ready = 0
+        if ready <= self.next_bar:
+            return []
+        bar_st, bar_et = self.next_bar * self.ticks_per_bar, ready * self.ticks_per_bar
+        self.next_bar = ready
+
+        n_notes = np.searchsorted(self.notes[:, 0], bar_et, side='left')
+        notes, self.notes = self.notes[:n_notes], self.notes[n_notes:]
+        n_chords = np.searchsorted(self.chord_starts, bar_et, side='left')
+        chord_starts = np.array(self.chord_starts[:n_chords], dtype=np.int64)
+        chord_words = np.array(self.chord_words[:n_chords], dtype=np.int64)
+        del self.chord_starts[:n_chords], self.chord_words[:n_chords]
+        tempo_starts = np.arange(-(-bar_st // DEFAULT_RESOLUTION) * DEFAULT_RESOLUTION,
+                                 min(bar_et, self.last_tempo_time + 1), DEFAULT_RESOLUTION)
+        if len(notes) == 0:
+            return []
+
+        # only bars with notes are tokenized
+        note_bars = np.unique(notes[:, 0] // self.ticks_per_bar)
+        chord_kept = np.isin(chord_starts // self.ticks_per_bar, note_bars)
+        chord_starts, chord_words = chord_starts[chord_kept], chord_words[chord_kept]
+        tempo_starts = tempo_starts[np.isin(tempo_starts // self.ticks_per_bar, note_bars)]
+        tempos = self.tempos[np.searchsorted(self.tempo_times, tempo_starts, side='right') - 1]
+        # tempo class and value, a tempo without class repeats the last tempo of the previous bars
+        if self.previous_tempo is None:
+            classes, values = tempo_classes(tempos)
+        else:
+            classes, values = tempo_classes(np.concatenate([[self.previous_tempo], tempos]))
+            classes, values = classes[1:], values[1:]
+        matched = tempos[tempos != DEFAULT_TEMPO_INTERVALS[2].stop]
+        if len(matched) > 0:
+            self.previous_tempo = matched[-1]
+
+        # chords, then tempos, then notes at the same start, like the stable sort of group_items
+        n_chords, n_tempos = len(chord_starts), len(tempo_starts)
+        starts = np.concatenate([chord_starts, tempo_starts, notes[:, 0]])
+        order = np.argsort(starts, kind='stable')
+        kinds = np.repeat([ITEM_CHORD, ITEM_TEMPO, ITEM_NOTE], [n_chords, n_tempos, len(notes)])[order]
+        items = np.zeros((len(starts), 4), dtype=np.int64)
+        items[:, 0] = starts
+        items[n_chords + n_tempos:] = notes
+        items = items[order]
+        bars = items[:, 0] // self.ticks_per_bar
+        first_in_bar = np.flatnonzero(np.concatenate([[True], bars[1:] != bars[:-1]]))
+        words = bar_words(first_in_bar, bars * self.ticks_per_bar, (bars + 1) * self.ticks_per_bar, kinds, items,
+                          chord_words, classes, values, self.word_table)
+        return np.split(words, np.flatnonzero(words == self.word_table.bar)[1:])
+
+
+# words of a stream of notes bar by bar, see BarTokenizer
+# note_blocks: (n, 4) arrays of [start, end, velocity, pitch] in read_items order, not quantized
+# tempo_times, tempos: every tempo change of the file
+def iter_bar_words(note_blocks, tempo_times, tempos, word_table, chords=True, ticks_per_bar=DEFAULT_RESOLUTION * 4):
+    tokenizer = BarTokenizer(tempo_times, tempos, word_table, chords=chords, ticks_per_bar=ticks_per_bar)
+    for notes in note_blocks:
+        yield from tokenizer.feed(notes)
+    yield from tokenizer.close()
+
+
+# words of a midi file bar by bar, same words as NotezartTransformer.extract_words
+# the file is parsed by miditoolkit in full, its notes then go through the tokenizer block_size at a time
+def iter_file_words(file_path, word_table, chords=True, block_size=4096):
+    notes, tempo_times, tempos = read_arrays(file_path)
+    blocks = (notes[start:start + block_size] for start in range(0, len(notes), block_size))
+    return iter_bar_words(blocks, tempo_times, tempos, word_table, chords=chords)
+
+
 #############################################################################################
 # WRITE MIDI
 #############################################################################################
@@ -238,94 +651,75 @@ def word_to_event(words, word2event):
     return events
 
 
-def write_midi(words, word2event, output_path, prompt_path=None):
-    events = word_to_event(words, word2event)
-    # get downbeat and note (no time)
-    temp_notes = []
-    temp_chords = []
-    temp_tempos = []
-    for i in range(len(events) - 3):
-        if events[i].name == 'Bar' and i > 0:
-            temp_notes.append('Bar')
-            temp_chords.append('Bar')
-            temp_tempos.append('Bar')
-        elif events[i].name == 'Position' and \
-                events[i + 1].name == 'Note Velocity' and \
-                events[i + 2].name == 'Note On' and \
-                events[i + 3].name == 'Note Duration':
-            # start time and end time from position
-            position = int(events[i].value.split('/')[0]) - 1
-            # velocity
-            index = int(events[i + 1].value)
-            velocity = int(DEFAULT_VELOCITY_BINS[index])
-            # pitch
-            pitch = int(events[i + 2].value)
-            # duration
-            index = int(events[i + 3].value)
-            duration = DEFAULT_DURATION_BINS[index]
-            # adding
-            temp_notes.append([position, velocity, pitch, duration])
-        elif events[i].name == 'Position' and events[i + 1].name == 'Chord':
-            position = int(events[i].value.split('/')[0]) - 1
-            temp_chords.append([position, events[i + 1].value])
-        elif events[i].name == 'Position' and \
-                events[i + 1].name == 'Tempo Class' and \
-                events[i + 2].name == 'Tempo Value':
-            position = int(events[i].value.split('/')[0]) - 1
-            if events[i + 1].value == 'slow':
-                tempo = DEFAULT_TEMPO_INTERVALS[0].start + int(events[i + 2].value)
-            elif events[i + 1].value == 'mid':
-                tempo = DEFAULT_TEMPO_INTERVALS[1].start + int(events[i + 2].value)
-            elif events[i + 1].value == 'fast':
-                tempo = DEFAULT_TEMPO_INTERVALS[2].start + int(events[i + 2].value)
-            temp_tempos.append([position, tempo])
-    # get specific time for notes
-    ticks_per_beat = DEFAULT_RESOLUTION
+# word types of the decoder lookup tables
+WORD_OTHER, WORD_BAR, WORD_POSITION, WORD_VELOCITY, WORD_PITCH, WORD_DURATION, WORD_CHORD, WORD_TEMPO_CLASS, \
+    WORD_TEMPO_VALUE = range(9)
+
+
+# precomputed word => (type, value) lookup tables, so decoding never splits strings
+# value is the position index, velocity, pitch, duration in ticks, chord index, tempo class start or tempo value
+class DecodeTable(object):
+    def __init__(self, word2event):
+        size = max(word2event) + 1 if len(word2event) > 0 else 0
+        self.type = np.full(size, WORD_OTHER, dtype=np.int8)
+        self.value = np.zeros(size, dtype=np.int64)
+        self.chords = []
+        tempo_classes = {'slow': DEFAULT_TEMPO_INTERVALS[0].start,
+                         'mid': DEFAULT_TEMPO_INTERVALS[1].start,
+                         'fast': DEFAULT_TEMPO_INTERVALS[2].start}
+        for word, event in word2event.items():
+            name, value = event.split('_', 1)
+            if name == 'Bar':
+                self.type[word] = WORD_BAR
+            elif name == 'Position':
+                self.type[word], self.value[word] = WORD_POSITION, int(value.split('/')[0]) - 1
+            elif name == 'Note Velocity':
+                self.type[word], self.value[word] = WORD_VELOCITY, DEFAULT_VELOCITY_BINS[int(value)]
+            elif name == 'Note On':
+                self.type[word], self.value[word] = WORD_PITCH, int(value)
+            elif name == 'Note Duration':
+                self.type[word], self.value[word] = WORD_DURATION, DEFAULT_DURATION_BINS[int(value)]
+            elif name == 'Chord':
+                self.type[word], self.value[word] = WORD_CHORD, len(self.chords)
+                self.chords.append(value)
+            elif name == 'Tempo Class' and value in tempo_classes:
+                self.type[word], self.value[word] = WORD_TEMPO_CLASS, tempo_classes[value]
+            elif name == 'Tempo Value':
+                self.type[word], self.value[word] = WORD_TEMPO_VALUE, int(value)
+
+
+# word to (notes, chords, tempos) with ticks, all patterns are matched at once
+# notes: [start, end, velocity, pitch] rows, chords: [(start, name)], tempos: [start, bpm] rows
+def decode_words(words, table):
+    words = np.asarray(words, dtype=np.int64)
+    if len(words) < 4:
+        return np.zeros((0, 4), dtype=np.int64), [], np.zeros((0, 2), dtype=np.int64)
+    types = table.type[words]
+    values = table.value[words]
+    # a pattern starting at i looks at tokens i .. i+3, the last 3 tokens never start one
+    n = len(words) - 3
+    t0, t1, t2, t3 = types[:n], types[1:n + 1], types[2:n + 2], types[3:n + 3]
+    v0, v1, v2, v3 = values[:n], values[1:n + 1], values[2:n + 2], values[3:n + 3]
+    # bar of each token: number of Bar tokens before it (except the first token)
+    is_bar = t0 == WORD_BAR
+    is_bar[0] = False
+    bar = np.cumsum(is_bar)
+    # start time from position
     ticks_per_bar = DEFAULT_RESOLUTION * 4  # assume 4/4
-    notes = []
-    current_bar = 0
-    for note in temp_notes:
-        if note == 'Bar':
-            current_bar += 1
-        else:
-            position, velocity, pitch, duration = note
-            # position (start time)
-            current_bar_st = current_bar * ticks_per_bar
-            current_bar_et = (current_bar + 1) * ticks_per_bar
-            flags = np.linspace(current_bar_st, current_bar_et, DEFAULT_FRACTION, endpoint=False, dtype=int)
-            st = flags[position]
-            # duration (end time)
-            et = st + duration
-            notes.append(miditoolkit.Note(velocity, pitch, st, et))
-    # get specific time for chords
-    if len(temp_chords) > 0:
-        chords = []
-        current_bar = 0
-        for chord in temp_chords:
-            if chord == 'Bar':
-                current_bar += 1
-            else:
-                position, value = chord
-                # position (start time)
-                current_bar_st = current_bar * ticks_per_bar
-                current_bar_et = (current_bar + 1) * ticks_per_bar
-                flags = np.linspace(current_bar_st, current_bar_et, DEFAULT_FRACTION, endpoint=False, dtype=int)
-                st = flags[position]
-                chords.append([st, value])
-    # get specific time for tempos
-    tempos = []
-    current_bar = 0
-    for tempo in temp_tempos:
-        if tempo == 'Bar':
-            current_bar += 1
-        else:
-            position, value = tempo
-            # position (start time)
-            current_bar_st = current_bar * ticks_per_bar
-            current_bar_et = (current_bar + 1) * ticks_per_bar
-            flags = np.linspace(current_bar_st, current_bar_et, DEFAULT_FRACTION, endpoint=False, dtype=int)
-            st = flags[position]
-            tempos.append([int(st), value])
+    ticks = bar * ticks_per_bar + v0 * ticks_per_bar // DEFAULT_FRACTION
+    is_position = t0 == WORD_POSITION
+    is_note = is_position & (t1 == WORD_VELOCITY) & (t2 == WORD_PITCH) & (t3 == WORD_DURATION)
+    is_chord = is_position & (t1 == WORD_CHORD)
+    is_tempo = is_position & (t1 == WORD_TEMPO_CLASS) & (t2 == WORD_TEMPO_VALUE)
+    notes = np.stack([ticks[is_note], ticks[is_note] + v3[is_note], v1[is_note], v2[is_note]], axis=1)
+    chords = list(zip(ticks[is_chord].tolist(), [table.chords[i] for i in v1[is_chord]]))
+    tempos = np.stack([ticks[is_tempo], v1[is_tempo] + v2[is_tempo]], axis=1)
+    return notes, chords, tempos
+
+
+def decoded_to_midi(notes, chords, tempos, output_path, prompt_path=None):
+    notes = [miditoolkit.Note(velocity, pitch, st, et) for st, et, velocity, pitch in notes.tolist()]
+    tempos = tempos.tolist()
     # write
     if prompt_path:
         midi = miditoolkit.midi.parser.MidiFile(prompt_path)
@@ -342,15 +736,11 @@ def write_midi(words, word2event, output_path, prompt_path=None):
                 temp_tempos.append(tempo)
             else:
                 break
-        for st, bpm in tempos:
-            st += last_time
-            temp_tempos.append(miditoolkit.midi.containers.TempoChange(bpm, st))
+        temp_tempos.extend(miditoolkit.midi.containers.TempoChange(bpm, st + last_time) for st, bpm in tempos)
         midi.tempo_changes = temp_tempos
         # write chord into marker
-        if len(temp_chords) > 0:
-            for c in chords:
-                midi.markers.append(
-                    miditoolkit.midi.containers.Marker(text=c[1], time=c[0] + last_time))
+        midi.markers.extend(
+            miditoolkit.midi.containers.Marker(text=text, time=st + last_time) for st, text in chords)
     else:
         midi = miditoolkit.midi.parser.MidiFile()
         midi.ticks_per_beat = DEFAULT_RESOLUTION
@@ -359,150 +749,27 @@ def write_midi(words, word2event, output_path, prompt_path=None):
         inst.notes = notes
         midi.instruments.append(inst)
         # write tempo
-        tempo_changes = []
-        for st, bpm in tempos:
-            tempo_changes.append(miditoolkit.midi.containers.TempoChange(bpm, st))
-        midi.tempo_changes = tempo_changes
+        midi.tempo_changes = [miditoolkit.midi.containers.TempoChange(bpm, st) for st, bpm in tempos]
         # write chord into marker
-        if len(temp_chords) > 0:
-            for c in chords:
-                midi.markers.append(
-                    miditoolkit.midi.containers.Marker(text=c[1], time=c[0]))
+        midi.markers.extend(miditoolkit.midi.containers.Marker(text=text, time=st) for st, text in chords)
     # write
     midi.dump(output_path)
 
 
+# pass a DecodeTable built once when writing many files with the same dictionary
+def write_midi(words, word2event, output_path, prompt_path=None, table=None):
+    if table is None:
+        table = DecodeTable(word2event)
+    notes, chords, tempos = decode_words(words, table)
+    decoded_to_midi(notes, chords, tempos, output_path, prompt_path)
+
+
 def events_to_midi(events, output_path, prompt_path=None):
-    temp_notes = []
-    temp_chords = []
-    temp_tempos = []
-    for i in range(len(events) - 3):
-        if events[i].name == 'Bar' and i > 0:
-            temp_notes.append('Bar')
-            temp_chords.append('Bar')
-            temp_tempos.append('Bar')
-        elif events[i].name == 'Position' and \
-                events[i + 1].name == 'Note Velocity' and \
-                events[i + 2].name == 'Note On' and \
-                events[i + 3].name == 'Note Duration':
-            # start time and end time from position
-            position = int(events[i].value.split('/')[0]) - 1
-            # velocity
-            index = int(events[i + 1].value)
-            velocity = int(DEFAULT_VELOCITY_BINS[index])
-            # pitch
-            pitch = int(events[i + 2].value)
-            # duration
-            index = int(events[i + 3].value)
-            duration = DEFAULT_DURATION_BINS[index]
-            # adding
-            temp_notes.append([position, velocity, pitch, duration])
-        elif events[i].name == 'Position' and events[i + 1].name == 'Chord':
-            position = int(events[i].value.split('/')[0]) - 1
-            temp_chords.append([position, events[i + 1].value])
-        elif events[i].name == 'Position' and \
-                events[i + 1].name == 'Tempo Class' and \
-                events[i + 2].name == 'Tempo Value':
-            position = int(events[i].value.split('/')[0]) - 1
-            if events[i + 1].value == 'slow':
-                tempo = DEFAULT_TEMPO_INTERVALS[0].start + int(events[i + 2].value)
-            elif events[i + 1].value == 'mid':
-                tempo = DEFAULT_TEMPO_INTERVALS[1].start + int(events[i + 2].value)
-            elif events[i + 1].value == 'fast':
-                tempo = DEFAULT_TEMPO_INTERVALS[2].start + int(events[i + 2].value)
-            temp_tempos.append([position, tempo])
-    # get specific time for notes
-    ticks_per_beat = DEFAULT_RESOLUTION
-    ticks_per_bar = DEFAULT_RESOLUTION * 4  # assume 4/4
-    notes = []
-    current_bar = 0
-    for note in temp_notes:
-        if note == 'Bar':
-            current_bar += 1
-        else:
-            position, velocity, pitch, duration = note
-            # position (start time)
-            current_bar_st = current_bar * ticks_per_bar
-            current_bar_et = (current_bar + 1) * ticks_per_bar
-            flags = np.linspace(current_bar_st, current_bar_et, DEFAULT_FRACTION, endpoint=False, dtype=int)
-            st = flags[position]
-            # duration (end time)
-            et = st + duration
-            notes.append(miditoolkit.Note(velocity, pitch, st, et))
-    # get specific time for chords
-    if len(temp_chords) > 0:
-        chords = []
-        current_bar = 0
-        for chord in temp_chords:
-            if chord == 'Bar':
-                current_bar += 1
-            else:
-                position, value = chord
-                # position (start time)
-                current_bar_st = current_bar * ticks_per_bar
-                current_bar_et = (current_bar + 1) * ticks_per_bar
-                flags = np.linspace(current_bar_st, current_bar_et, DEFAULT_FRACTION, endpoint=False, dtype=int)
-                st = flags[position]
-                chords.append([st, value])
-    # get specific time for tempos
-    tempos = []
-    current_bar = 0
-    for tempo in temp_tempos:
-        if tempo == 'Bar':
-            current_bar += 1
-        else:
-            position, value = tempo
-            # position (start time)
-            current_bar_st = current_bar * ticks_per_bar
-            current_bar_et = (current_bar + 1) * ticks_per_bar
-            flags = np.linspace(current_bar_st, current_bar_et, DEFAULT_FRACTION, endpoint=False, dtype=int)
-            st = flags[position]
-            tempos.append([int(st), value])
-    # write
-    if prompt_path:
-        midi = miditoolkit.midi.parser.MidiFile(prompt_path)
-        #
-        last_time = DEFAULT_RESOLUTION * 4 * 4
-        # note shift
-        for note in notes:
-            note.start += last_time
-            note.end += last_time
-        midi.instruments[0].notes.extend(notes)
-        # tempo changes
-        temp_tempos = []
-        for tempo in midi.tempo_changes:
-            if tempo.time < DEFAULT_RESOLUTION * 4 * 4:
-                temp_tempos.append(tempo)
-            else:
-                break
-        for st, bpm in tempos:
-            st += last_time
-            temp_tempos.append(miditoolkit.midi.containers.TempoChange(bpm, st))
-        midi.tempo_changes = temp_tempos
-        # write chord into marker
-        if len(temp_chords) > 0:
-            for c in chords:
-                midi.markers.append(
-                    miditoolkit.midi.containers.Marker(text=c[1], time=c[0] + last_time))
-    else:
-        midi = miditoolkit.midi.parser.MidiFile()
-        midi.ticks_per_beat = DEFAULT_RESOLUTION
-        # write instrument
-        inst = miditoolkit.midi.containers.Instrument(0, is_drum=False)
-        inst.notes = notes
-        midi.instruments.append(inst)
-        # write tempo
-        tempo_changes = []
-        for st, bpm in tempos:
-            tempo_changes.append(miditoolkit.midi.containers.TempoChange(bpm, st))
-        midi.tempo_changes = tempo_changes
-        # write chord into marker
-        if len(temp_chords) > 0:
-            for c in chords:
-                midi.markers.append(
-                    miditoolkit.midi.containers.Marker(text=c[1], time=c[0]))
-    # write
-    midi.dump(output_path)
+    # number the distinct events, then decode them like words
+    event2word = {}
+    words = [event2word.setdefault(event.to_key(), len(event2word)) for event in events]
+    word2event = {word: event for event, word in event2word.items()}
+    write_midi(words, word2event, output_path, prompt_path)
 
 
 #############################################################################################
@@ -593,41 +860,71 @@ class MIDIChord(object):
                 qualities[root_note] = quality
         return scores, qualities
 
+    # best roots (bitmask), quality and score of every root for each of the 4096 chroma masks,
+    # built once from sequencing and scoring and shared by all instances
+    _chord_table = None
+
+    def chord_table(self):
+        if MIDIChord._chord_table is None:
+            best_roots = np.zeros(4096, dtype=np.int64)
+            qualities = np.full((4096, 12), 'N', dtype=object)
+            scores = np.zeros((4096, 12), dtype=np.int64)
+            for mask in range(1, 4096):
+                chroma = (mask >> np.arange(12)) & 1
+                candidates = self.sequencing(chroma=chroma)
+                _scores, _qualities = self.scoring(candidates=candidates)
+                _max = max(_scores.values())
+                for root_note, score in _scores.items():
+                    scores[mask, root_note] = score
+                    qualities[mask, root_note] = _qualities[root_note]
+                    if score == _max:
+                        best_roots[mask] |= 1 << root_note
+            MIDIChord._chord_table = best_roots, qualities, scores
+        return MIDIChord._chord_table
+
     def find_chord(self, pianoroll):
-        chroma = miditoolkit.pianoroll.utils.tochroma(pianoroll=pianoroll)
-        chroma = np.sum(chroma, axis=0)
-        chroma = np.array([1 if c else 0 for c in chroma])
-        if np.sum(chroma) == 0:
-            return 'N', 'N', 'N', 0
-        else:
-            candidates = self.sequencing(chroma=chroma)
-            scores, qualities = self.scoring(candidates=candidates)
-            # bass note
-            sorted_notes = []
-            for i, v in enumerate(np.sum(pianoroll, axis=0)):
-                if v > 0:
-                    sorted_notes.append(int(i % 12))
-            bass_note = sorted_notes[0]
-            # root note
-            __root_note = []
-            _max = max(scores.values())
-            for _root_note, score in scores.items():
-                if score == _max:
-                    __root_note.append(_root_note)
-            if len(__root_note) == 1:
-                root_note = __root_note[0]
+        return self.find_chord_from_pitches(active=np.sum(pianoroll, axis=0) > 0)
+
+    # same as find_chord, from the (128,) mask of pitches sounding in the window
+    def find_chord_from_pitches(self, active):
+        return self.find_chords(active=np.asarray(active)[None, :])[0]
+
+    # find_chord for many windows at once, from their (windows, 128) masks of sounding pitches
+    def find_chords(self, active):
+        best_roots, qualities, scores = self.chord_table()
+        active = np.asarray(active, dtype=bool)
+        pitch_classes = np.arange(active.shape[1]) % 12
+        masks = np.bitwise_or.reduce(np.where(active, 1 << pitch_classes, 0), axis=1)
+        # bass note: lowest sounding pitch
+        bass_notes = pitch_classes[np.argmax(active, axis=1)]
+        # root note: lowest sounding pitch among the best scoring roots
+        is_root = active & ((best_roots[masks][:, None] >> pitch_classes) & 1).astype(bool)
+        root_notes = pitch_classes[np.argmax(is_root, axis=1)]
+        chords = []
+        for mask, root_note, bass_note, quality, score in zip(
+                masks.tolist(), root_notes.tolist(), bass_notes.tolist(),
+                qualities[masks, root_notes], scores[masks, root_notes].tolist()):
+            if mask == 0:
+                chords.append(('N', 'N', 'N', 0))
             else:
-                # TODO: what should i do
-                for n in sorted_notes:
-                    if n in __root_note:
-                        root_note = n
-                        break
-            # quality
-            quality = qualities.get(root_note)
-            sequence = candidates.get(root_note)
-            # score
-            score = scores.get(root_note)
-            return self.PITCH_CLASSES[root_note], quality, self.PITCH_CLASSES[bass_note], score
+                chords.append((self.PITCH_CLASSES[root_note], quality, self.PITCH_CLASSES[bass_note], score))
+        return chords
+
+    # number of notes sounding in every beat, per pitch: the beat-level version of note2pianoroll
+    # (notes without velocity are dropped and zero-length notes last one tick, like in notes2pianoroll)
+    # notes is a (n, 4) array of [start, end, velocity, pitch]
+    def beat_counts(self, notes, max_tick, ticks_per_beat):
+        n_beats = -(-max_tick // ticks_per_beat)
+        notes = notes[notes[:, 2] != 0]
+        starts, ends, pitches = notes[:, 0], notes[:, 1], notes[:, 3]
+        ends = np.minimum(np.where(ends == starts, starts + 1, ends), max_tick)
+        keep = ends > starts
+        starts, ends, pitches = starts[keep], ends[keep], pitches[keep]
+        # +1 on the first beat of a note, -1 after its last beat
+        diff = np.zeros((n_beats + 1, 128), dtype=np.int64)
+        np.add.at(diff, (starts // ticks_per_beat, pitches), 1)
+        np.add.at(diff, ((ends - 1) // ticks_per_beat + 1, pitches), -1)
+        return np.cumsum(diff[:-1], axis=0)
 
     def greedy(self, candidates, max_tick, min_length):
         chords = []
@@ -662,32 +959,42 @@ class MIDIChord(object):
         return temp2
 
     def extract(self, notes):
+        notes = np.array([[n.start, n.end, n.velocity, n.pitch] for n in notes], dtype=np.int64)
+        return self.extract_arrays(notes=notes)
+
+    # extract from a (n, 4) array of [start, end, velocity, pitch]
+    def extract_arrays(self, notes):
         # read
-        max_tick = max([n.end for n in notes])
+        max_tick = int(notes[:, 1].max())
         ticks_per_beat = 480
-        pianoroll = self.note2pianoroll(
+        # prefix sums over beats, so any window of beats is one subtraction
+        counts = self.beat_counts(
             notes=notes,
             max_tick=max_tick,
             ticks_per_beat=ticks_per_beat)
+        n_beats = len(counts)
+        prefix = np.zeros((n_beats + 1, 128), dtype=np.int64)
+        np.cumsum(counts, axis=0, out=prefix[1:])
         # get lots of candidates
         candidates = {}
+        beats = np.arange(n_beats)
         # the shortest: 2 beat, longest: 4 beat
         for interval in [4, 2]:
-            for start_tick in range(0, max_tick, ticks_per_beat):
-                # set target pianoroll
+            # set target windows, the last beat may be cut by max_tick
+            active = prefix[np.minimum(beats + interval, n_beats)] - prefix[beats] > 0
+            # find chords
+            chords = self.find_chords(active=active)
+            for start_tick, chord in zip(range(0, max_tick, ticks_per_beat), chords):
                 end_tick = int(ticks_per_beat * interval + start_tick)
                 if end_tick > max_tick:
                     end_tick = max_tick
-                _pianoroll = pianoroll[start_tick:end_tick, :]
-                # find chord
-                root_note, quality, bass_note, score = self.find_chord(pianoroll=_pianoroll)
                 # save
                 if start_tick not in candidates:
                     candidates[start_tick] = {}
-                    candidates[start_tick][end_tick] = (root_note, quality, bass_note, score)
+                    candidates[start_tick][end_tick] = chord
                 else:
                     if end_tick not in candidates[start_tick]:
-                        candidates[start_tick][end_tick] = (root_note, quality, bass_note, score)
+                        candidates[start_tick][end_tick] = chord
         # greedy
         chords = self.greedy(candidates=candidates,
                              max_tick=max_tick,
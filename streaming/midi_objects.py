@@ -28,12 +28,15 @@ class MidiSong:
         self.notes = {}
 
     @staticmethod
-    def load(path):
+    def load(path, quarantine=None):
         """
         Populate this MIDI song from a midi file path
         Args:
             path (str): file path
+            quarantine (Quarantine): skip files that failed before, and record new failures
         """
+        if quarantine is not None and quarantine.is_quarantined(path):
+            return None
         try:
             song = MidiSong()
             midi = pretty_midi.PrettyMIDI(path)
@@ -45,7 +48,10 @@ class MidiSong:
                 song.add_notes(instr, [MidiNote.from_note(note) for note in pm_instrument.notes])
 
             return song
-        except:
+        except Exception as e:
+            if quarantine is not None:
+                quarantine.add(path, f"{type(e).__name__}: {e}")
+                quarantine.save()
             return None
 
     @staticmethod
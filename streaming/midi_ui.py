@@ -1,4 +1,3 @@
-import random
 from collections import defaultdict
 from collections import deque
 from threading import Timer
@@ -179,9 +178,9 @@ class MidiUi:
                     elif event.type == pg.KEYDOWN:
                         if event.key == pg.K_z:
                             self.midi_queue.clear()
-                            path = load_data.get_all_files()[random.randint(0, 500)]
+                            path = load_data.random_file()
                             print(path)
-                            midi_song = MidiSong.load(path)
+                            midi_song = MidiSong.load(path, quarantine=load_data.get_quarantine())
                             self.add_song_to_queue(midi_song)
 
                 self.update()